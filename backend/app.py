@@ -1,16 +1,29 @@
+import io
 import os
+import base64
+import binascii
+import re
 import json
 import uuid
+import mimetypes
+import hashlib
+import tempfile
 import jwt
 import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from functools import wraps
 
 # Import your existing classes
-from contract_analyzer import ContractAnalyzer, DatabaseManager
+from contract_analyzer import (
+    RISK_LEVELS, ContractAnalyzer, DatabaseManager, PoolTimeoutError, get_llm_cache, risk_levels_for_scores
+)
+import contract_analyzer
+from job_queue import AnalysisJobQueue
+from auth_cache import RevocationList, UserCache
+from export_analyses import EXPORT_FORMATS, EXPORT_MIMETYPES, export_analyses
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -20,6 +33,19 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 
+# Hand file downloads to the front web server instead of streaming them from Python:
+# "x-accel" (nginx X-Accel-Redirect), "x-sendfile" (Apache/lighttpd X-Sendfile) or empty
+DOWNLOAD_OFFLOAD = os.getenv('DOWNLOAD_OFFLOAD', '').lower()
+# nginx `internal` location aliased to UPLOAD_FOLDER, used with DOWNLOAD_OFFLOAD=x-accel
+DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/')
+app.config['USE_X_SENDFILE'] = DOWNLOAD_OFFLOAD == 'x-sendfile'
+
+# Most documents returned per page of the document list
+DOCUMENT_PAGE_MAX = int(os.getenv('DOCUMENT_PAGE_MAX', '200'))
+
+# Uploads stored before content-addressed storage: <YYYYmmddHHMMSS>_<filename>
+LEGACY_UPLOAD_NAME = re.compile(r'^(\d{14})_(.+)$')
+
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -29,39 +55,208 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Next-Cursor')
     return response
 
-# Database manager
+# Database manager (connects and checks the schema, including users, on first use)
 db_manager = DatabaseManager()
 
-# Create users table if it doesn't exist
-def create_users_table():
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP NOT NULL
-            )
-        ''')
+# Background analysis workers
+def run_analysis_job(job):
+    if job.get('document_id'):
+        # An earlier attempt saved the document and then failed; don't analyze it twice
+        analysis = build_document_analysis(job['document_id'], job['user_id'])
+        if analysis is not None:
+            return {key: value for key, value in analysis.items() if key not in ('clauses', 'metadata')}
+    
+    analyzer = ContractAnalyzer(db_manager)
+    return analyzer.analyze_document(
+        job['file_path'],
+        user_id=job['user_id'],
+        filename=job['filename'],
+        content_hash=job.get('content_hash'),
+        on_saved=lambda document_id: job_queue.record_document(job['id'], document_id)
+    )
+
+job_queue = AnalysisJobQueue(db_manager, run_analysis_job)
+
+# Authenticated users and revoked tokens, so token_required rarely touches the database.
+# Call user_cache.invalidate(user_id) after changing or deleting a user.
+user_cache = UserCache(db_manager.get_user)
+revoked_tokens = RevocationList(db_manager.get_revoked_tokens)
+
+# Load models, open the pool and start workers before serving traffic.
+# Call once per worker process; gunicorn.conf.py does it from post_fork.
+def warm_up():
+    contract_analyzer.warm_up(db_manager)
+    job_queue.start()
+
+# Servers without a warm-up hook (flask run, other WSGI servers) start the
+# analysis workers on the first request, so queued jobs don't wait for an upload
+@app.before_first_request
+def start_job_queue():
+    job_queue.start()
+
+# Helper functions
+def upload_path(content_hash, extension):
+    """Where an upload with this hash lives: <UPLOAD_FOLDER>/ab/cd/<sha256>.<ext>."""
+    return os.path.join(
+        app.config['UPLOAD_FOLDER'], content_hash[:2], content_hash[2:4], f"{content_hash}.{extension}"
+    )
+
+def save_upload(file, extension):
+    """
+    Stream an upload to disk while hashing it. Files are stored under their
+    SHA-256, so identical bytes are kept only once, and sharded by the first
+    two hash bytes so no directory grows unbounded. Returns (content_hash, file_path).
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+                digest.update(block)
+                out.write(block)
         
-        # Add user_id column to documents table if it doesn't exist
-        cursor.execute('''
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name='documents' AND column_name='user_id'
-        ''')
+        content_hash = digest.hexdigest()
+        file_path = upload_path(content_hash, extension)
         
-        if cursor.fetchone() is None:
-            cursor.execute('ALTER TABLE documents ADD COLUMN user_id INTEGER')
-            
-        db_manager.conn.commit()
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(temp_path, file_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    
+    return content_hash, file_path
 
-create_users_table()
+def encode_page_cursor(upload_date, document_id):
+    """Opaque cursor for the document list page after (upload_date, document_id)."""
+    return base64.urlsafe_b64encode(f"{upload_date.isoformat()}|{document_id}".encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor):
+    """(upload_date, document_id) from a page cursor. Raises ValueError if it is malformed."""
+    try:
+        upload_date, document_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    except (UnicodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+    return datetime.datetime.fromisoformat(upload_date), int(document_id)
+
+def find_legacy_upload(filename, upload_date):
+    """
+    Find a file saved under the old <timestamp>_<filename> naming. Only exact
+    names count; if several uploads share a name, the one saved closest to the
+    document's upload date wins. Returns the path or None.
+    """
+    name = LEGACY_UPLOAD_NAME.sub(r'\2', filename)
+    wanted = {filename, secure_filename(name)}
+    best = None
+    
+    with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            match = LEGACY_UPLOAD_NAME.match(entry.name)
+            if not match or match.group(2) not in wanted or not entry.is_file():
+                continue
+            if entry.name == filename:
+                return entry.path
+            saved_at = datetime.datetime.strptime(match.group(1), '%Y%m%d%H%M%S')
+            distance = abs((saved_at - upload_date).total_seconds()) if upload_date else 0
+            if best is None or distance < best[0]:
+                best = (distance, entry.path)
+    
+    return best[1] if best else None
+
+def send_stored_file(path, download_name, etag=None):
+    """
+    Send a stored upload as an attachment. Range and If-None-Match /
+    If-Modified-Since requests are answered by send_file; with DOWNLOAD_OFFLOAD
+    set, the web server sends the bytes and Python only sets headers.
+    """
+    if DOWNLOAD_OFFLOAD == 'x-accel':
+        # nginx serves the file, ranges and validators included, from its internal location
+        relative = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        response.headers['X-Accel-Redirect'] = DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + relative
+        return response
+    
+    return send_file(path, as_attachment=True, download_name=download_name, conditional=True, etag=etag or True)
+
+def build_document_analysis(document_id, user_id):
+    """
+    The stored analysis of a document the user owns, or None. Served from the
+    latest analysis snapshot; documents analyzed before snapshots existed get
+    one built from their risk analysis rows and saved on first view.
+    """
+    row = db_manager.get_analysis_snapshot(document_id, user_id)
+    if not row:
+        return None
+    
+    filename, upload_date, analysis, is_clone = row
+    if analysis is None:
+        analysis = build_legacy_analysis(document_id)
+        # A clone without one is usually a copy of a document whose analysis is still
+        # being saved; it picks up the original's snapshot once that lands
+        if not is_clone:
+            db_manager.save_analysis_snapshot(document_id, analysis)
+    
+    # Clones share the original's snapshot; these come from the document itself
+    analysis.update({
+        'document_id': document_id,
+        'filename': filename,
+        'upload_date': upload_date.strftime('%Y-%m-%d %H:%M:%S')
+    })
+    return analysis
+
+def build_legacy_analysis(document_id):
+    """Rebuild an analysis result from stored rows for a document without a snapshot."""
+    with db_manager.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'SELECT filename, doc_type, metadata FROM documents WHERE id = %s',
+            (document_id,)
+        )
+        filename, doc_type, metadata = cursor.fetchone()
+        
+        # Get risk analysis for document
+        cursor.execute(
+            '''
+            SELECT clause_type, clause_text, risk_score, risk_explanation, analysis_date
+            FROM risk_analysis
+            WHERE document_id = %s
+            ORDER BY id
+            ''',
+            (document_id,)
+        )
+        risk_analyses = cursor.fetchall()
+    
+    # Format clauses
+    risk_levels = risk_levels_for_scores([row[2] for row in risk_analyses])
+    clauses = []
+    for (clause_type, clause_text, risk_score, risk_explanation, _), risk_level in zip(risk_analyses, risk_levels):
+        clauses.append({
+            'type': clause_type,
+            'text': clause_text,
+            'risk_score': risk_score,
+            'risk_level': str(risk_level),
+            'explanation': risk_explanation
+        })
+    
+    return {
+        'document_id': document_id,
+        'filename': filename,
+        'document_type': doc_type,
+        'metadata': metadata,
+        'important_clauses': clauses,
+        'clauses': clauses,
+        'overall_risk_score': sum(clause['risk_score'] for clause in clauses) / len(clauses) if clauses else 0,
+        'analysis_date': risk_analyses[0][4].strftime('%Y-%m-%d %H:%M:%S') if risk_analyses else None,
+        'summary': f"Analysis of {filename} ({doc_type})"  # Simple summary as a fallback
+    }
 
-# Helper functions
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -81,24 +276,23 @@ def token_required(f):
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
-            # Decode token
+            # Decode token; the signature and expiry check needs no database
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
             
-            # Get user from database
-            with db_manager.conn.cursor() as cursor:
-                cursor.execute('SELECT * FROM users WHERE id = %s', (data['userId'],))
-                user = cursor.fetchone()
-                
-                if not user:
-                    return jsonify({'message': 'User not found'}), 401
-                    
-                # Add user info to request context
-                request.user = {
-                    'id': user[0],
-                    'name': user[1],
-                    'email': user[2]
-                }
+            if data.get('jti') and revoked_tokens.is_revoked(data['jti']):
+                return jsonify({'message': 'Token has been revoked'}), 401
+            
+            # Get user, from the cache unless it is missing or stale
+            user = user_cache.get(data['userId'])
+            if not user:
+                return jsonify({'message': 'User not found'}), 401
+            
+            # Add user info and token claims to request context
+            request.user = dict(user)
+            request.token_claims = data
                 
+        except PoolTimeoutError as e:
+            return jsonify({'message': 'Server busy, please retry', 'error': str(e)}), 503
         except Exception as e:
             return jsonify({'message': 'Invalid token', 'error': str(e)}), 401
             
@@ -106,6 +300,26 @@ def token_required(f):
     
     return decorated
 
+# Health check with connection pool and LLM cache statistics for tuning
+@app.route('/api/health', methods=['GET'])
+def health():
+    try:
+        with db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        status, code = 'ok', 200
+    except PoolTimeoutError:
+        status, code = 'pool exhausted', 503
+    except Exception as e:
+        status, code = f'database unavailable: {str(e)}', 503
+    
+    return jsonify({
+        'status': status,
+        'db_pool': db_manager.pool_stats(),
+        'llm_cache': get_llm_cache().stats(),
+        'document_chunk_cache': db_manager.document_chunks.stats(),
+        'auth': {**user_cache.stats(), **revoked_tokens.stats()}
+    }), code
+
 # Authentication routes
 @app.route('/api/auth/register', methods=['POST', 'OPTIONS'])
 def register():
@@ -118,7 +332,7 @@ def register():
         return jsonify({'message': 'Missing required fields'}), 400
     
     # Check if user already exists
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute('SELECT * FROM users WHERE email = %s', (data['email'],))
         if cursor.fetchone():
             return jsonify({'message': 'User already exists'}), 409
@@ -127,13 +341,12 @@ def register():
     hashed_password = generate_password_hash(data['password'])
     
     # Create new user
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute(
             'INSERT INTO users (name, email, password, created_at) VALUES (%s, %s, %s, %s) RETURNING id',
             (data['name'], data['email'], hashed_password, datetime.datetime.now())
         )
         user_id = cursor.fetchone()[0]
-        db_manager.conn.commit()
     
     return jsonify({'message': 'User created successfully', 'userId': user_id}), 201
 
@@ -148,7 +361,7 @@ def login():
         return jsonify({'message': 'Missing email or password'}), 400
     
     # Find user
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute('SELECT * FROM users WHERE email = %s', (data['email'],))
         user = cursor.fetchone()
         
@@ -160,11 +373,28 @@ def login():
             'userId': user[0],
             'email': user[2],
             'name': user[1],
+            'jti': uuid.uuid4().hex,
             'exp': datetime.datetime.now() + datetime.timedelta(hours=24)
         }, app.config['SECRET_KEY'], algorithm='HS256')
         
         return jsonify({'token': token, 'user': {'id': user[0], 'name': user[1], 'email': user[2]}}), 200
 
+@app.route('/api/auth/logout', methods=['POST', 'OPTIONS'])
+@token_required
+def logout():
+    if request.method == 'OPTIONS':
+        return {'message': 'OK'}, 200
+    
+    # Tokens issued before logout existed carry no jti and simply run until they expire
+    jti = request.token_claims.get('jti')
+    if jti:
+        # PyJWT stores the naive datetime it was given as if it were UTC
+        expires_at = datetime.datetime.utcfromtimestamp(request.token_claims['exp'])
+        db_manager.revoke_token(jti, request.user['id'], expires_at)
+        revoked_tokens.add(jti, expires_at)
+    
+    return jsonify({'message': 'Logged out'}), 200
+
 # Document routes
 @app.route('/api/documents/upload', methods=['POST', 'OPTIONS'])
 @token_required
@@ -187,81 +417,68 @@ def upload_document():
     if not '.' in file.filename or file.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
         return jsonify({'message': 'File type not allowed'}), 400
     
-    # Save file
+    # Save file, hashing it as it streams in
     filename = secure_filename(file.filename)
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-    unique_filename = f"{timestamp}_{filename}"
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-    file.save(file_path)
+    content_hash, file_path = save_upload(file, file.filename.rsplit('.', 1)[1].lower())
     
-    # Analyze document
-    analyzer = ContractAnalyzer(db_manager)
-    analysis = analyzer.analyze_document(file_path)
+    with db_manager.connection():
+        # Concurrent uploads of the same file by this user take turns from here until commit
+        db_manager.lock_upload(request.user['id'], content_hash)
+        
+        # Already being analyzed for this user: report that job. Checked before the
+        # documents, since a job saves its document before it stops running.
+        job_id = job_queue.find_active_job(request.user['id'], content_hash)
+        
+        # Identical bytes were analyzed before: link or clone that analysis instead of recomputing
+        existing = db_manager.find_document_by_hash(content_hash, request.user['id']) if job_id is None else None
+        if existing:
+            document_id, owner_id = existing
+            if owner_id != request.user['id']:
+                document_id = db_manager.clone_document(document_id, request.user['id'], filename)
+            
+            analysis = build_document_analysis(document_id, request.user['id'])
+            analysis['deduplicated'] = True
+        elif job_id is None:
+            # Queue the document for background analysis
+            job_id = job_queue.enqueue(request.user['id'], file_path, filename, content_hash=content_hash)
     
-    # Update document with user_id
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute(
-            'UPDATE documents SET user_id = %s WHERE id = %s',
-            (request.user['id'], analysis['document_id'])
-        )
-        db_manager.conn.commit()
+    if existing:
+        return jsonify(analysis), 200
     
-    return jsonify(analysis), 200
+    # The job is visible to workers now that it has committed
+    job_queue.wake()
+    
+    response = jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}'
+    })
+    response.headers['Location'] = f'/api/jobs/{job_id}'
+    return response, 202
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET', 'OPTIONS'])
+@token_required
+def get_job_status(job_id):
+    if request.method == 'OPTIONS':
+        return {'message': 'OK'}, 200
+    
+    job = job_queue.get_job(job_id, request.user['id'])
+    
+    if not job:
+        return jsonify({'message': 'Job not found or access denied'}), 404
+    
+    return jsonify(job), 200
 
 @app.route('/api/documents/<int:document_id>', methods=['GET', 'OPTIONS'])
 @token_required
 def get_document_analysis(document_id):
     if request.method == 'OPTIONS':
         return {'message': 'OK'}, 200
-        
-    # Check if document exists and belongs to user
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute(
-            'SELECT * FROM documents WHERE id = %s AND user_id = %s',
-            (document_id, request.user['id'])
-        )
-        document = cursor.fetchone()
-        
-        if not document:
-            return jsonify({'message': 'Document not found or access denied'}), 404
-    
-    # Get risk analysis for document
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute(
-            '''
-            SELECT id, clause_type, clause_text, risk_score, risk_explanation, analysis_date
-            FROM risk_analysis
-            WHERE document_id = %s
-            ''',
-            (document_id,)
-        )
-        risk_analyses = cursor.fetchall()
     
-    # Format important clauses
-    important_clauses = []
-    for analysis in risk_analyses:
-        risk_level = "high" if analysis[3] >= 0.7 else "medium" if analysis[3] >= 0.4 else "low" if analysis[3] >= 0.1 else "negligible"
-        
-        important_clauses.append({
-            'type': analysis[1],
-            'text': analysis[2],
-            'risk_score': analysis[3],
-            'risk_level': risk_level,
-            'explanation': analysis[4]
-        })
+    response = build_document_analysis(document_id, request.user['id'])
     
-    # Prepare response
-    response = {
-        'document_id': document_id,
-        'filename': document[1],
-        'document_type': document[2],
-        'upload_date': document[3].strftime('%Y-%m-%d %H:%M:%S'),
-        'metadata': document[5],
-        'important_clauses': important_clauses,
-        'overall_risk_score': sum(clause['risk_score'] for clause in important_clauses) / len(important_clauses) if important_clauses else 0,
-        'analysis_date': risk_analyses[0][5].strftime('%Y-%m-%d %H:%M:%S') if risk_analyses else None,
-        'summary': f"Analysis of {document[1]} ({document[2]})"  # Simple summary as a fallback
-    }
+    if not response:
+        return jsonify({'message': 'Document not found or access denied'}), 404
     
     return jsonify(response), 200
 
@@ -271,19 +488,31 @@ def get_user_documents():
     if request.method == 'OPTIONS':
         return {'message': 'OK'}, 200
         
-    # Get all documents for the user
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute(
-            '''
-            SELECT d.id, d.filename, d.doc_type, d.upload_date, d.metadata,
-                   (SELECT AVG(risk_score) FROM risk_analysis WHERE document_id = d.id) as avg_risk
-            FROM documents d
-            WHERE d.user_id = %s
-            ORDER BY d.upload_date DESC
-            ''',
-            (request.user['id'],)
-        )
-        documents = cursor.fetchall()
+    # Without a limit every document is returned, as before; with one, pages follow X-Next-Cursor
+    try:
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, DOCUMENT_PAGE_MAX))
+        after = decode_page_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return jsonify({'message': 'Invalid cursor'}), 400
+    
+    risk_level = request.args.get('risk')
+    if risk_level and risk_level not in RISK_LEVELS:
+        return jsonify({'message': f"risk must be one of {', '.join(RISK_LEVELS)}"}), 400
+    
+    # One more row than asked for tells whether there is a next page
+    documents = db_manager.list_user_documents(
+        request.user['id'],
+        limit=limit + 1 if limit is not None else None,
+        after=after,
+        doc_type=request.args.get('doc_type'),
+        risk_level=risk_level
+    )
+    next_cursor = None
+    if limit is not None and len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_page_cursor(documents[-1][3], documents[-1][0])
     
     # Format response
     response = []
@@ -293,11 +522,15 @@ def get_user_documents():
             'filename': doc[1],
             'document_type': doc[2],
             'upload_date': doc[3].strftime('%Y-%m-%d %H:%M:%S'),
-            'overall_risk_score': float(doc[5]) if doc[5] is not None else 0,
+            'overall_risk_score': float(doc[4]) if doc[4] is not None else 0,
+            'clause_count': doc[5] or 0,
             'analysis_date': doc[3].strftime('%Y-%m-%d %H:%M:%S')
         })
     
-    return jsonify(response), 200
+    response = jsonify(response)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
 
 @app.route('/api/documents/<int:document_id>/query', methods=['POST', 'OPTIONS'])
 @token_required
@@ -311,60 +544,78 @@ def query_document_api(document_id):
         return jsonify({'message': 'Missing query parameter'}), 400
     
     # Check if document exists and belongs to user
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute(
-            'SELECT * FROM documents WHERE id = %s AND user_id = %s',
+            'SELECT id FROM documents WHERE id = %s AND user_id = %s',
             (document_id, request.user['id'])
         )
-        document = cursor.fetchone()
         
-        if not document:
+        if not cursor.fetchone():
             return jsonify({'message': 'Document not found or access denied'}), 404
     
     # Query document
     analyzer = ContractAnalyzer(db_manager)
-    result = analyzer.query_document(data['query'], document_id)
+    result = analyzer.query_document(data['query'], document_id, user_id=request.user['id'])
     
     return jsonify(result), 200
 
-@app.route('/api/documents/<int:document_id>/download', methods=['GET', 'OPTIONS'])
+def sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/documents/<int:document_id>/query/stream', methods=['POST', 'OPTIONS'])
 @token_required
-def download_document(document_id):
+def stream_query_document_api(document_id):
     if request.method == 'OPTIONS':
         return {'message': 'OK'}, 200
         
+    data = request.get_json()
+    
+    if not data or not data.get('query'):
+        return jsonify({'message': 'Missing query parameter'}), 400
+    
     # Check if document exists and belongs to user
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute(
-            'SELECT filename FROM documents WHERE id = %s AND user_id = %s',
+            'SELECT id FROM documents WHERE id = %s AND user_id = %s',
             (document_id, request.user['id'])
         )
-        document = cursor.fetchone()
-        
-        if not document:
+        if not cursor.fetchone():
             return jsonify({'message': 'Document not found or access denied'}), 404
     
-    # Find the document file
-    filename = document[0]
-    # This assumes documents are stored with the same name as in database
-    # You may need to adapt this to your actual storage strategy
-    for file in os.listdir(app.config['UPLOAD_FOLDER']):
-        if filename in file:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file)
-            return send_file(file_path, as_attachment=True, download_name=filename)
+    analyzer = ContractAnalyzer(db_manager)
+    events = analyzer.stream_query_document(data['query'], document_id, user_id=request.user['id'])
     
-    return jsonify({'message': 'File not found'}), 404
+    def generate():
+        # If the client disconnects, the server closes this generator, which
+        # closes the analyzer's stream and the upstream Together AI request
+        try:
+            for event in events:
+                name = event.pop('event')
+                yield sse_event(name, event)
+        finally:
+            events.close()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Stop nginx from buffering the stream
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
-@app.route('/api/documents/<int:document_id>/report', methods=['GET', 'OPTIONS'])
+@app.route('/api/documents/<int:document_id>/download', methods=['GET', 'OPTIONS'])
 @token_required
-def download_report(document_id):
+def download_document(document_id):
     if request.method == 'OPTIONS':
         return {'message': 'OK'}, 200
         
     # Check if document exists and belongs to user
-    with db_manager.conn.cursor() as cursor:
+    with db_manager.connection() as conn, conn.cursor() as cursor:
         cursor.execute(
-            'SELECT * FROM documents WHERE id = %s AND user_id = %s',
+            'SELECT filename, storage_path, content_hash, upload_date FROM documents WHERE id = %s AND user_id = %s',
             (document_id, request.user['id'])
         )
         document = cursor.fetchone()
@@ -372,46 +623,71 @@ def download_report(document_id):
         if not document:
             return jsonify({'message': 'Document not found or access denied'}), 404
     
-    # Get risk analysis for document
-    with db_manager.conn.cursor() as cursor:
-        cursor.execute(
-            '''
-            SELECT id, clause_type, clause_text, risk_score, risk_explanation, analysis_date
-            FROM risk_analysis
-            WHERE document_id = %s
-            ''',
-            (document_id,)
-        )
-        risk_analyses = cursor.fetchall()
+    filename, storage_path, content_hash, upload_date = document
+    if not (storage_path and os.path.exists(storage_path)):
+        # Look a legacy upload up once, then remember where it is
+        storage_path = find_legacy_upload(filename, upload_date)
+        if not storage_path:
+            return jsonify({'message': 'File not found'}), 404
+        db_manager.set_storage_path(document_id, storage_path)
+    
+    download_name = LEGACY_UPLOAD_NAME.sub(r'\2', filename)
+    return send_stored_file(storage_path, download_name, content_hash)
+
+@app.route('/api/documents/<int:document_id>/report', methods=['GET', 'OPTIONS'])
+@token_required
+def download_report(document_id):
+    if request.method == 'OPTIONS':
+        return {'message': 'OK'}, 200
+        
+    analysis = build_document_analysis(document_id, request.user['id'])
+    
+    if not analysis:
+        return jsonify({'message': 'Document not found or access denied'}), 404
     
     # Format report data
     report_data = {
         'document_id': document_id,
-        'filename': document[1],
-        'document_type': document[2],
-        'upload_date': document[3].strftime('%Y-%m-%d %H:%M:%S'),
-        'clauses': []
+        'filename': analysis['filename'],
+        'document_type': analysis['document_type'],
+        'upload_date': analysis['upload_date'],
+        'summary': analysis['summary'],
+        'overall_risk_score': analysis['overall_risk_score'],
+        'clauses': analysis.get('clauses', analysis['important_clauses'])
     }
     
-    for analysis in risk_analyses:
-        risk_level = "high" if analysis[3] >= 0.7 else "medium" if analysis[3] >= 0.4 else "low" if analysis[3] >= 0.1 else "negligible"
-        
-        report_data['clauses'].append({
-            'type': analysis[1],
-            'text': analysis[2],
-            'risk_score': analysis[3],
-            'risk_level': risk_level,
-            'explanation': analysis[4]
-        })
+    report = io.BytesIO(json.dumps(report_data, indent=2).encode('utf-8'))
+    return send_file(report, mimetype='application/json', as_attachment=True,
+                     download_name=f"analysis_report_{analysis['filename']}.json")
+
+@app.route('/api/documents/export', methods=['GET', 'OPTIONS'])
+@token_required
+def export_documents():
+    if request.method == 'OPTIONS':
+        return {'message': 'OK'}, 200
+    
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'message': f"Unsupported format, use one of: {', '.join(sorted(EXPORT_FORMATS))}"}), 400
     
-    # Create a temporary JSON file
-    temp_filename = f"report_{document_id}.json"
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
+    # Optional comma-separated document ids; all of the user's documents otherwise
+    try:
+        document_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'message': 'ids must be comma-separated document ids'}), 400
     
-    with open(temp_path, 'w') as f:
-        json.dump(report_data, f, indent=2)
+    # Rows are read through a server-side cursor and written out batch by batch
+    export = export_analyses(db_manager, fmt, user_id=request.user['id'], document_ids=document_ids or None)
     
-    return send_file(temp_path, as_attachment=True, download_name=f"analysis_report_{document[1]}.json")
+    return Response(
+        stream_with_context(export),
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename=analyses_export.{fmt}',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
 if __name__ == '__main__':
+    warm_up()
     app.run(debug=False, port=5000)
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Auth cache settings
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+AUTH_USER_CACHE_ENTRIES = int(os.getenv("AUTH_USER_CACHE_ENTRIES", "10000"))
+AUTH_REVOCATION_REFRESH = float(os.getenv("AUTH_REVOCATION_REFRESH", "5"))
+
+# Revocations committed late can carry a revoked_at a little before the newest
+# one already seen, so every refresh looks back this far
+REVOCATION_OVERLAP = timedelta(seconds=60)
+
+
+class UserCache:
+    """
+    In-process cache of user records keyed by user id. Entries expire after a
+    TTL, so changes made by another process show up within that time; changes
+    made here should call invalidate() right away. Only found users are cached.
+    """
+
+    def __init__(self, load: Callable[[int], Optional[Dict]], ttl: float = AUTH_USER_CACHE_TTL,
+                 max_entries: int = AUTH_USER_CACHE_ENTRIES):
+        self.load = load
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """The user record, from memory when fresh, otherwise from load()."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._users.move_to_end(user_id)
+                self._stats["hits"] += 1
+                return entry[1]
+            self._stats["misses"] += 1
+
+        user = self.load(user_id)
+        if user is not None:
+            with self._lock:
+                self._users[user_id] = (now + self.ttl, user)
+                self._users.move_to_end(user_id)
+                while len(self._users) > self.max_entries:
+                    self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        """Forget one user (after it changed or was deleted), or everyone."""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._users)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+class RevocationList:
+    """
+    Token ids (jti) revoked before they expired. Kept in memory and topped up
+    from the database at most every refresh seconds, so checking a token never
+    waits on a query; tokens revoked in this process count immediately.
+    """
+
+    def __init__(self, load_since: Callable[[Optional[datetime]], List[Tuple[str, datetime, datetime]]],
+                 refresh: float = AUTH_REVOCATION_REFRESH):
+        self.load_since = load_since
+        self.refresh = refresh
+        self._revoked: Dict[str, datetime] = {}
+        self._since: Optional[datetime] = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _maybe_refresh(self) -> None:
+        if time.monotonic() < self._next_refresh:
+            return
+        # One thread refreshes; the others keep using the current list
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() < self._next_refresh:
+                return
+            since = self._since - REVOCATION_OVERLAP if self._since else None
+            rows = self.load_since(since)
+            now = datetime.now()
+            with self._lock:
+                for jti, expires_at, revoked_at in rows:
+                    self._revoked[jti] = expires_at
+                    if self._since is None or revoked_at > self._since:
+                        self._since = revoked_at
+                # Expired tokens are rejected by the signature check anyway
+                for jti in [jti for jti, expires_at in self._revoked.items() if expires_at < now]:
+                    del self._revoked[jti]
+            self._next_refresh = time.monotonic() + self.refresh
+        finally:
+            self._refresh_lock.release()
+
+    def is_revoked(self, jti: str) -> bool:
+        self._maybe_refresh()
+        with self._lock:
+            return jti in self._revoked
+
+    def add(self, jti: str, expires_at: datetime) -> None:
+        """Record a revocation made in this process (the caller stores it durably)."""
+        with self._lock:
+            self._revoked[jti] = expires_at
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"revoked_tokens": len(self._revoked)}
@@ -0,0 +1,55 @@
+"""
+Check that importing contract_analyzer stays cheap.
+
+Runs `python -X importtime -c "import contract_analyzer"` in a fresh
+interpreter, prints the slowest imports and exits non-zero when the total
+exceeds IMPORT_TIME_BUDGET seconds. Heavy libraries (torch, OpenCV, the
+Together client) should only be imported on first use, never at module level.
+"""
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "1.5"))
+MODULE = "contract_analyzer"
+
+
+def measure_imports(module: str) -> List[Tuple[int, str]]:
+    """Return (cumulative microseconds, package) for every import, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(f"Importing {module} failed")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|", 2)
+        timings.append((int(cumulative), package.rstrip()))
+    return timings
+
+
+def main():
+    timings = measure_imports(MODULE)
+    total = next((us for us, package in timings if package.strip() == MODULE), 0) / 1e6
+
+    print(f"Slowest imports under {MODULE}:")
+    top_level = [(us, package.strip()) for us, package in timings if not package.startswith("  ")]
+    for us, package in sorted(top_level, reverse=True)[:10]:
+        print(f"  {us / 1e6:8.3f}s  {package}")
+
+    print(f"\nimport {MODULE}: {total:.3f}s (budget {IMPORT_TIME_BUDGET:.3f}s)")
+    if total > IMPORT_TIME_BUDGET:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
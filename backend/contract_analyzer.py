@@ -1,21 +1,34 @@
 import os
-import cv2
+import hashlib
+import importlib.util
 import numpy as np
-import pytesseract
-import PyPDF2
 import re
-from PIL import Image
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 import json
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
-import torch
-from typing import Dict, List, Tuple, Any, Optional
+from typing import Dict, List, Tuple, Any, Optional, Iterator, Callable
 import argparse
-from sklearn.metrics.pairwise import cosine_similarity
-import pandas as pd
+import math
+import multiprocessing
+import threading
+import time
 from dotenv import load_dotenv
-from together import Together  # Import Together AI client
+from llm_cache import LLMCache
+from embedding_server import EMBEDDING_SERVER_SOCKET, EmbeddingClient
+from embedding_codec import encode_embedding, stored_vectors
+from migrations import check_version, migrate as migrate_schema
+
+# Heavy libraries (torch/sentence-transformers, OpenCV, Tesseract, PyPDF2, the
+# Together client) are imported where they are first used, so importing this
+# module stays fast for the web app, CLI runs and worker restarts.
+
+# Rasterizing scanned PDF pages for OCR needs pdf2image (and poppler); it's optional
+PDF2IMAGE_AVAILABLE = importlib.util.find_spec("pdf2image") is not None
 
 # Load environment variables
 load_dotenv()
@@ -27,14 +40,70 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "sumedh")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
-# Initialize Together AI client
+# Connection pool sizing (tune under load via /api/health)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+# Apply pending schema migrations on startup instead of only checking the version (handy in development)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "").lower() in ("1", "true", "yes")
+
+# Together AI settings (the client is created on first use)
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "99119015c00e5e948acff2763710ed0cd93b9dad1b3bbe4b794c120f5d01675f")
-together_client = Together(api_key=TOGETHER_API_KEY)
 TOGETHER_MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
 
-# Initialize embedding model - we'll keep using sentence-transformers for embeddings
-# as they're optimized for this purpose
-model = SentenceTransformer('all-MiniLM-L6-v2')  # Free and lightweight model from HuggingFace
+# Embedding model - we'll keep using sentence-transformers for embeddings
+# as they're optimized for this purpose (loaded on first use)
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'  # Free and lightweight model from HuggingFace
+
+# Number of chunks sent through the embedding model per forward pass
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# With an embedding server configured, encode locally when it fails instead of
+# failing the analysis (a retry will try the server again). Off by default:
+# loading the model in every worker is what the server exists to avoid.
+EMBEDDING_LOCAL_FALLBACK = os.getenv("EMBEDDING_LOCAL_FALLBACK", "").lower() in ("1", "true", "yes")
+
+# Prototype clause classifier: a chunk takes the clause type whose mean historical
+# embedding it is closest to, if that similarity clears the threshold and beats
+# the runner-up by the margin; otherwise the regex rules decide
+CLAUSE_PROTOTYPE_MIN_SIMILARITY = float(os.getenv("CLAUSE_PROTOTYPE_MIN_SIMILARITY", "0.55"))
+CLAUSE_PROTOTYPE_MARGIN = float(os.getenv("CLAUSE_PROTOTYPE_MARGIN", "0.05"))
+CLAUSE_PROTOTYPE_MIN_EXAMPLES = int(os.getenv("CLAUSE_PROTOTYPE_MIN_EXAMPLES", "20"))
+
+# Chunk budget in model tokens; all-MiniLM-L6-v2 truncates input beyond 256
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+# A new section heading or numbered clause starts a new chunk once the current one has this many tokens
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "16"))
+
+# Question answering: chunks retrieved per question, the context budget in model
+# tokens, how much keyword overlap counts next to embedding similarity, and how
+# many documents' chunk matrices stay cached between questions
+QUERY_TOP_K = int(os.getenv("QUERY_TOP_K", "8"))
+QUERY_CONTEXT_TOKENS = int(os.getenv("QUERY_CONTEXT_TOKENS", "1500"))
+QUERY_LEXICAL_WEIGHT = float(os.getenv("QUERY_LEXICAL_WEIGHT", "0.2"))
+QUERY_CACHE_DOCUMENTS = int(os.getenv("QUERY_CACHE_DOCUMENTS", "32"))
+
+# Other processes' new embeddings reach the clause index within this many seconds
+CLAUSE_INDEX_REFRESH = float(os.getenv("CLAUSE_INDEX_REFRESH", "10"))
+# Embedding ids are assigned before commit, so a refresh re-reads this many ids
+# below the newest one seen to catch rows committed out of order
+CLAUSE_INDEX_REFRESH_OVERLAP = int(os.getenv("CLAUSE_INDEX_REFRESH_OVERLAP", "10000"))
+
+# Bump when the shape of stored analysis snapshots changes
+SNAPSHOT_FORMAT_VERSION = 1
+
+# PDFs with at least this many pages are extracted across a process pool
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "4"))
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+
+# PDF pages with fewer non-whitespace characters than this are treated as scanned and OCRed
+OCR_MIN_PAGE_CHARS = int(os.getenv("OCR_MIN_PAGE_CHARS", "25"))
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "ocr_cache")
+
+# Pages are joined with a paragraph break so page boundaries survive in the full text
+PAGE_SEPARATOR = "\n\n"
 
 # Risk score thresholds
 RISK_THRESHOLDS = {
@@ -43,6 +112,21 @@ RISK_THRESHOLDS = {
     "low": 0.1
 }
 
+# Default risk per clause type when there is no comparable history
+DEFAULT_CLAUSE_RISKS = {
+    "payment_terms": 0.6,
+    "termination": 0.7,
+    "liability": 0.8,
+    "confidentiality": 0.7,
+    "intellectual_property": 0.7,
+    "data_protection": 0.8,
+    "warranty": 0.6,
+    "indemnification": 0.7,
+    "force_majeure": 0.5,
+    "non_compete": 0.6,
+    "governing_law": 0.4
+}
+
 # Important clause types to look for
 IMPORTANT_CLAUSES = [
     "payment_terms", 
@@ -58,219 +142,1629 @@ IMPORTANT_CLAUSES = [
     "governing_law"
 ]
 
+RISK_LEVELS = np.array(["negligible", "low", "medium", "high"])
+
+
+def risk_levels_for_scores(scores: np.ndarray) -> np.ndarray:
+    """Bucket an array of risk scores into risk level names."""
+    bins = [RISK_THRESHOLDS["low"], RISK_THRESHOLDS["medium"], RISK_THRESHOLDS["high"]]
+    return RISK_LEVELS[np.digitize(scores, bins)]
+
+
+def risk_band(level: str) -> Tuple[Optional[float], Optional[float]]:
+    """The [lower, upper) score range of a risk level; None where the range is open."""
+    bins = [None, RISK_THRESHOLDS["low"], RISK_THRESHOLDS["medium"], RISK_THRESHOLDS["high"], None]
+    index = list(RISK_LEVELS).index(level)
+    return bins[index], bins[index + 1]
+
+
+def weighted_risk_scores(similarities: np.ndarray, risk_scores: np.ndarray) -> np.ndarray:
+    """
+    Similarity-weighted average of neighbour risk scores, one per row.
+    Rows whose weights sum to zero or less get the default mid-level risk.
+    """
+    total_weight = similarities.sum(axis=1)
+    weighted = (similarities * risk_scores).sum(axis=1)
+    safe_total = np.where(total_weight > 0, total_weight, 1.0)
+    return np.where(total_weight > 0, weighted / safe_total, 0.5)
+
+
+_model = None
+_model_lock = threading.Lock()
+_together_client = None
+_together_client_lock = threading.Lock()
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_embedding_model():
+    """Load the sentence-transformers model on first use (thread-safe)."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _model
+
+
+def get_embedding_client() -> Optional[EmbeddingClient]:
+    """Client for the shared embedding server, or None when EMBEDDING_SERVER_SOCKET is unset."""
+    if not EMBEDDING_SERVER_SOCKET:
+        return None
+    return EmbeddingClient(EMBEDDING_SERVER_SOCKET)
+
+
+_embedding_fallback_warned = False
+
+
+def _embedding_server_failed(error: Exception) -> None:
+    """
+    Handle a failed embedding server call: return to encode locally when
+    EMBEDDING_LOCAL_FALLBACK is set (warning once per process), otherwise
+    raise a ConnectionError so the analysis job is retried later.
+    """
+    global _embedding_fallback_warned
+    if not EMBEDDING_LOCAL_FALLBACK:
+        raise ConnectionError(f"Embedding server failed: {str(error)}") from error
+    if not _embedding_fallback_warned:
+        _embedding_fallback_warned = True
+        print(f"Warning: embedding server failed ({str(error)}); this process now loads its own model when it has to")
+
+
+def get_together_client():
+    """Create the Together AI client on first use (thread-safe)."""
+    global _together_client
+    if _together_client is None:
+        with _together_client_lock:
+            if _together_client is None:
+                from together import Together
+                _together_client = Together(api_key=TOGETHER_API_KEY)
+    return _together_client
+
+
+def get_llm_cache() -> LLMCache:
+    """Open the LLM response cache on first use (thread-safe)."""
+    global _llm_cache
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                # Identical prompts are answered from cache instead of calling Together AI again
+                _llm_cache = LLMCache()
+    return _llm_cache
+
+
+def warm_up(db_manager: Optional["DatabaseManager"] = None) -> None:
+    """
+    Load the embedding model (or reach the embedding server) and API clients
+    up front so the first request doesn't pay for them. Given a database manager, also opens the pool,
+    checks the schema and loads the clause index.
+    """
+    start = time.perf_counter()
+    client = get_embedding_client()
+    if client is not None:
+        try:
+            client.encode(["warm up"])
+        except (OSError, RuntimeError) as e:
+            # Encoding tries the server again per call; only load the model if it may fall back to it
+            print(f"Embedding server unavailable at warm-up ({str(e)})")
+            if EMBEDDING_LOCAL_FALLBACK:
+                client = None
+    if client is None:
+        get_embedding_model().encode(["warm up"], show_progress_bar=False)
+    get_together_client()
+    get_llm_cache()
+    if db_manager is not None:
+        db_manager.initialize()
+        db_manager.ensure_clause_index()
+    print(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Return the shared process pool used for CPU-bound extraction work."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Workers are started clean rather than forked: this process has live
+            # threads, pooled connections and sockets a forked child would inherit
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _process_pool = ProcessPoolExecutor(
+                max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context(method)
+            )
+        return _process_pool
+
+
+def _extract_pdf_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages [start, end) of a PDF. Runs in a worker process."""
+    import PyPDF2
+    
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _ocr_image(img: np.ndarray) -> str:
+    """Binarize an image with Otsu thresholding and run Tesseract on it."""
+    import cv2
+    import pytesseract
+    
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    return pytesseract.image_to_string(gray)
+
+
+def _pdf_page_fingerprint(page) -> bytes:
+    """
+    SHA-256 over a PDF page's content stream and the raw data of the images
+    and forms it draws, read without decoding or rendering anything.
+    """
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    
+    seen = set()
+    
+    def add_xobjects(resources) -> None:
+        xobjects = resources.get('/XObject') if resources else None
+        if not xobjects:
+            return
+        xobjects = xobjects.get_object()
+        for name in sorted(xobjects):
+            ref = xobjects.raw_get(name)
+            # Indirect objects shared between forms are hashed once
+            if hasattr(ref, 'idnum'):
+                if (ref.idnum, ref.generation) in seen:
+                    continue
+                seen.add((ref.idnum, ref.generation))
+            xobject = ref.get_object()
+            digest.update(f"{name}:{xobject.get('/Subtype')}".encode())
+            # Encoded bytes are enough to tell images apart, and cheaper than decoding
+            data = getattr(xobject, '_data', None)
+            digest.update(data if data is not None else xobject.get_data())
+            if xobject.get('/Subtype') == '/Form':
+                add_xobjects(xobject.get('/Resources'))
+    
+    add_xobjects(page.get('/Resources'))
+    return digest.digest()
+
+
+def _ocr_pdf_page(pdf_path: str, page_index: int, dpi: int, cache_dir: str) -> str:
+    """
+    Rasterize one PDF page and OCR it. Runs in a worker process.
+    Results are cached on disk under a hash of the page's content stream and
+    images plus the DPI, checked before rasterizing, so a page seen before (in
+    this or any other document) is neither rendered nor OCRed again.
+    """
+    import PyPDF2
+    from pdf2image import convert_from_path
+    
+    with open(pdf_path, 'rb') as file:
+        fingerprint = _pdf_page_fingerprint(PyPDF2.PdfReader(file).pages[page_index])
+    digest = hashlib.sha256(f"{dpi}:".encode() + fingerprint).hexdigest()
+    cache_path = os.path.join(cache_dir, digest[:2], f"{digest}.txt")
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f:
+            return f.read()
+    
+    image = convert_from_path(pdf_path, dpi=dpi, first_page=page_index + 1, last_page=page_index + 1, grayscale=True)[0]
+    text = _ocr_image(np.asarray(image))
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, cache_path)
+    return text
+
+
+def _needs_ocr(page_text: str) -> bool:
+    """Whether a PDF page's text layer is too sparse to be a real text page."""
+    return len(re.sub(r'\s+', '', page_text)) < OCR_MIN_PAGE_CHARS
+
+
+def file_sha256(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """Hex SHA-256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def page_offsets(pages: List[str]) -> List[int]:
+    """Character offset of each page's start within PAGE_SEPARATOR.join(pages)."""
+    offsets, position = [], 0
+    for page in pages:
+        offsets.append(position)
+        position += len(page) + len(PAGE_SEPARATOR)
+    return offsets
+
+
+# Clause keyword patterns in priority order: a chunk matching several types
+# takes the first listed as its primary type
+CLAUSE_PATTERNS = {
+    "payment_terms": r"payment\s+terms|pay\s+within|invoice\s+due|price|fee",
+    "termination": r"terminat(e|ion)|cancel|end\s+of\s+contract",
+    "liability": r"liab(le|ility)|responsible|obligation",
+    "confidentiality": r"confidential|non-disclosure|secret|proprietary",
+    "intellectual_property": r"intellectual\s+property|copyright|patent|trademark",
+    "data_protection": r"data\s+protection|privacy|personal\s+data|gdpr",
+    "warranty": r"warrant(y|ies)|guarantee",
+    "indemnification": r"indemnif(y|ication)|hold\s+harmless",
+    "force_majeure": r"force\s+majeure|act\s+of\s+god|unforeseen",
+    "non_compete": r"non-compete|competition|restraint\s+of\s+trade",
+    "governing_law": r"governing\s+law|jurisdiction|applicable\s+law"
+}
+
+# One alternation over every clause pattern, scanned once over lowercased text.
+# Each type's branch is a named group, so a match's lastgroup is its clause type.
+_CLAUSE_ALTERNATION = "|".join(f"(?P<{clause_type}>{pattern})" for clause_type, pattern in CLAUSE_PATTERNS.items())
+CLAUSE_DETECTOR = re.compile(_CLAUSE_ALTERNATION)
+CLAUSE_DETECTOR_ANY_CASE = re.compile(_CLAUSE_ALTERNATION, re.IGNORECASE)
+
+
+def detect_clause_spans(text: str) -> List[Tuple[int, int, str]]:
+    """Scan text once and return (start, end, clause_type) for every clause keyword match."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        matches = CLAUSE_DETECTOR.finditer(lowered)
+    else:
+        # A few characters change length when lowercased; keep the offsets exact
+        matches = CLAUSE_DETECTOR_ANY_CASE.finditer(text)
+    return [(match.start(), match.end(), match.lastgroup) for match in matches]
+
+
+def tag_spans(spans: List[Tuple[int, int]], clause_spans: List[Tuple[int, int, str]]) -> List[List[str]]:
+    """
+    Clause labels (in priority order) for each [start, end) span, from the
+    clause matches that lie entirely inside it. Both lists must be sorted by start.
+    """
+    labels = []
+    first = 0
+    for start, end in spans:
+        # Spans only move forward, so matches starting before this one never count again
+        while first < len(clause_spans) and clause_spans[first][0] < start:
+            first += 1
+        found = set()
+        i = first
+        while i < len(clause_spans) and clause_spans[i][0] < end:
+            if clause_spans[i][1] <= end:
+                found.add(clause_spans[i][2])
+            i += 1
+        labels.append([clause_type for clause_type in CLAUSE_PATTERNS if clause_type in found])
+    return labels
+
+
+def classify_by_prototype(embeddings: np.ndarray, clause_types: List[str], prototypes: np.ndarray,
+                          min_similarity: float = CLAUSE_PROTOTYPE_MIN_SIMILARITY,
+                          margin: float = CLAUSE_PROTOTYPE_MARGIN) -> Tuple[List[Optional[str]], np.ndarray]:
+    """
+    Score every chunk against every clause prototype in one matrix multiply.
+    Returns (clause type or None per chunk, best similarity per chunk); a chunk
+    gets None when its best match is below min_similarity or within margin of
+    the runner-up.
+    """
+    if len(embeddings) == 0 or not clause_types:
+        return [None] * len(embeddings), np.zeros(len(embeddings), dtype=np.float32)
+
+    similarities = _normalize_rows(embeddings) @ prototypes.T
+    best = np.argmax(similarities, axis=1)
+    best_similarity = similarities[np.arange(len(similarities)), best]
+    if len(clause_types) > 1:
+        runner_up = np.partition(similarities, -2, axis=1)[:, -2]
+    else:
+        runner_up = np.full(len(similarities), -1.0, dtype=np.float32)
+
+    confident = (best_similarity >= min_similarity) & (best_similarity - runner_up >= margin)
+    return [clause_types[i] if ok else None for i, ok in zip(best, confident)], best_similarity
+
+
+# Lines that open a new section or clause: "Article IV", "Section 5", "5.", "5.1.2",
+# "(a)", "(iv)" or an all-caps heading
+SECTION_START = re.compile(
+    r"[ \t]*(?:"
+    r"(?i:article|section|clause|schedule|exhibit|annex|appendix)\s+[\dIVXLCivxlc]+\b"
+    r"|\d+(?:\.\d+)*[.)]?\s"
+    r"|\([a-zA-Z0-9]{1,4}\)\s"
+    r"|[A-Z][A-Z0-9 ,;&/'()-]{3,}$"
+    r")"
+)
+LINE_PATTERN = re.compile(r".*(?:\n|$)")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?;])\s+(?=[\"'(\[]?[A-Z0-9])")
+WORD_PATTERN = re.compile(r"\S+")
+# Rough WordPiece estimate: words split into pieces of up to six characters, punctuation separately
+TOKEN_PATTERN = re.compile(r"\w{1,6}|[^\w\s]")
+CLAUSE_NUMBER = re.compile(r"^\s*(?:\d+(?:\.\d+)*[.)]?|\(?[a-z0-9]{1,4}[.)])\s*")
+
+# Boundary strength of a piece of text: where it starts decides whether it may open a new chunk
+BOUNDARY_SENTENCE, BOUNDARY_PARAGRAPH, BOUNDARY_SECTION = 0, 1, 2
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the embedding model's token count for text."""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def _strip_span(text: str, start: int, end: int) -> Tuple[int, int]:
+    """Shrink [start, end) to exclude surrounding whitespace."""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _iter_blocks(text: str) -> Iterator[Tuple[int, int, int]]:
+    """Yield (start, end, boundary) for each paragraph or clause block, split at blank lines and section starts."""
+    block_start = None
+    boundary = BOUNDARY_PARAGRAPH
+    for match in LINE_PATTERN.finditer(text):
+        line = match.group()
+        if not line.strip():
+            if block_start is not None:
+                yield block_start, match.start(), boundary
+                block_start = None
+            if match.end() == len(text):
+                break
+            continue
+        
+        starts_section = SECTION_START.match(line) is not None
+        if starts_section and block_start is not None:
+            yield block_start, match.start(), boundary
+            block_start = None
+        if block_start is None:
+            block_start = match.start()
+            boundary = BOUNDARY_SECTION if starts_section else BOUNDARY_PARAGRAPH
+    
+    if block_start is not None:
+        yield block_start, len(text), boundary
+
+
+def _iter_pieces(text: str, budget: int) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Yield (start, end, tokens, boundary) for each sentence of each block.
+    Sentences longer than the budget are cut at word boundaries.
+    """
+    for block_start, block_end, boundary in _iter_blocks(text):
+        sentence_start = block_start
+        breaks = [match.start() for match in SENTENCE_BREAK.finditer(text, block_start, block_end)]
+        for sentence_end in breaks + [block_end]:
+            start, end = _strip_span(text, sentence_start, sentence_end)
+            sentence_start = sentence_end
+            if start == end:
+                continue
+            
+            tokens = estimate_tokens(text[start:end])
+            if tokens <= budget:
+                yield start, end, tokens, boundary
+                boundary = BOUNDARY_SENTENCE
+                continue
+            
+            # Overlong sentence: pack whole words up to the budget
+            piece_start, piece_tokens = start, 0
+            piece_end = start
+            for word in WORD_PATTERN.finditer(text, start, end):
+                word_tokens = estimate_tokens(word.group())
+                if piece_tokens and piece_tokens + word_tokens > budget:
+                    yield piece_start, piece_end, piece_tokens, boundary
+                    boundary = BOUNDARY_SENTENCE
+                    piece_start, piece_tokens = word.start(), 0
+                piece_end = word.end()
+                piece_tokens += word_tokens
+            yield piece_start, piece_end, piece_tokens, boundary
+            boundary = BOUNDARY_SENTENCE
+
+
+def _chunk_fingerprint(chunk: str) -> str:
+    """Case-, spacing- and numbering-insensitive form of a chunk, for near-duplicate detection."""
+    return " ".join(re.findall(r"\w+", CLAUSE_NUMBER.sub("", chunk.lower())))
+
+
+def iter_chunk_spans(text: str, max_tokens: int = CHUNK_MAX_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                     dedupe: bool = True) -> Iterator[Tuple[int, int]]:
+    """
+    Stream non-overlapping [start, end) chunk offsets over text. Chunks are
+    packed from whole sentences up to the model's token budget and break at
+    section headings and numbered clauses (or at paragraphs once half full).
+    With dedupe, chunks repeating an earlier chunk's wording (boilerplate,
+    repeated headers and footers) are skipped.
+    """
+    # Leave room for the [CLS] and [SEP] tokens the model adds
+    budget = max(max_tokens - 2, 1)
+    seen = set()
+    chunk_start = chunk_end = None
+    chunk_tokens = 0
+    
+    def emit():
+        if not dedupe:
+            return True
+        fingerprint = _chunk_fingerprint(text[chunk_start:chunk_end])
+        if fingerprint in seen:
+            return False
+        seen.add(fingerprint)
+        return True
+    
+    for start, end, tokens, boundary in _iter_pieces(text, budget):
+        if chunk_start is not None and (
+            chunk_tokens + tokens > budget
+            or (boundary == BOUNDARY_SECTION and chunk_tokens >= min_tokens)
+            or (boundary == BOUNDARY_PARAGRAPH and chunk_tokens >= budget // 2)
+        ):
+            if emit():
+                yield chunk_start, chunk_end
+            chunk_start = None
+        
+        if chunk_start is None:
+            chunk_start, chunk_tokens = start, 0
+        chunk_end = end
+        chunk_tokens += tokens
+    
+    if chunk_start is not None and emit():
+        yield chunk_start, chunk_end
+
+
+# Common words that say nothing about which part of a contract a question is about
+QUERY_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it of on or "
+    "our shall should that the their there this to under us was we what when where which "
+    "who will with would you your".split()
+)
+
+
+def query_terms(text: str) -> set:
+    """Lowercased content words of text, for keyword overlap."""
+    return {term for term in re.findall(r"\w+", text.lower()) if term not in QUERY_STOPWORDS and len(term) > 1}
+
+
+def run_stage_graph(stages: Dict[str, Tuple[Callable[..., Any], List[str]]],
+                    max_workers: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Run named stages on a thread pool, each as soon as all of its
+    dependencies have finished. A stage is (function, dependency names) and
+    its function receives the dependencies' results as keyword arguments.
+    Returns (results by stage, seconds spent in each stage).
+    """
+    results: Dict[str, Any] = {}
+    timings: Dict[str, float] = {}
+    pending = dict(stages)
+    running = {}
+    
+    def timed(name: str, fn: Callable[..., Any], kwargs: Dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        try:
+            return fn(**kwargs)
+        finally:
+            timings[name] = time.perf_counter() - start
+    
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    future = executor.submit(timed, name, fn, {dep: results[dep] for dep in deps})
+                    running[future] = name
+                    del pending[name]
+            
+            if not running:
+                raise ValueError(f"Stages with unsatisfiable dependencies: {sorted(pending)}")
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Re-raises the first stage failure
+                results[running.pop(future)] = future.result()
+    
+    return results, timings
+
+
+def create_chat_completion(prompt: str, **params) -> str:
+    """Answer a single-message prompt with Together AI, through the LLM cache."""
+    messages = [{"role": "user", "content": prompt}]
+    key = LLMCache.make_key(TOGETHER_MODEL, messages, **params)
+    
+    def call() -> str:
+        response = get_together_client().chat.completions.create(model=TOGETHER_MODEL, messages=messages, **params)
+        return response.choices[0].message.content
+    
+    return get_llm_cache().get_or_compute(key, call)
+
+
+def stream_chat_completion(prompt: str, **params) -> Iterator[str]:
+    """
+    Stream the answer to a single-message prompt from Together AI as it is
+    generated. A cached answer is replayed in one piece, and a non-empty
+    answer from a stream that runs to completion is added to the LLM cache.
+    Closing the generator early (e.g. the client went away) closes the
+    upstream stream too.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    # Same key as create_chat_completion, so both share cached answers
+    key = LLMCache.make_key(TOGETHER_MODEL, messages, **params)
+    cache = get_llm_cache()
+    
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    
+    stream = get_together_client().chat.completions.create(model=TOGETHER_MODEL, messages=messages, stream=True, **params)
+    parts = []
+    completed = False
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        completed = True
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+    
+    # An error, a closed generator or an empty reply must not be served from cache later
+    answer = "".join(parts)
+    if completed and answer:
+        cache.put(key, answer)
+
+
+def _json_default(value):
+    """Serialize numpy scalars and dates that json.dumps doesn't know."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Return float32 copies of the given vectors scaled to unit length."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class _IndexPartition:
+    """Contiguous embedding matrix and row metadata for a single clause type."""
+
+    def __init__(self, dim: int, capacity: int):
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+        self.risk_scores = np.empty(capacity, dtype=np.float32)
+        self.rows: List[Tuple[str, float, str, str]] = []
+        self.size = 0
+        # Running sum of the (normalized) vectors, for the clause type's prototype
+        self.vector_sum = np.zeros(dim, dtype=np.float64)
+
+    def append(self, vectors: np.ndarray, rows: List[Tuple[str, float, str, str]]) -> None:
+        """Append normalized vectors, doubling the backing arrays when full."""
+        needed = self.size + len(rows)
+        if needed > self.matrix.shape[0]:
+            capacity = max(needed, self.matrix.shape[0] * 2)
+            matrix = np.empty((capacity, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            risk_scores = np.empty(capacity, dtype=np.float32)
+            risk_scores[:self.size] = self.risk_scores[:self.size]
+            self.matrix, self.risk_scores = matrix, risk_scores
+
+        self.matrix[self.size:needed] = vectors
+        self.risk_scores[self.size:needed] = [row[1] for row in rows]
+        self.rows.extend(rows)
+        self.size = needed
+        self.vector_sum += vectors.sum(axis=0, dtype=np.float64)
+
+
+class ClauseVectorIndex:
+    """
+    In-process nearest-neighbour index over stored clause embeddings.
+    Keeps one normalized float32 matrix per clause type so a lookup is a
+    single matrix-vector product followed by argpartition.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self._lock = threading.Lock()
+        self._initial_capacity = initial_capacity
+        self._partitions: Dict[str, _IndexPartition] = {}
+
+    def __len__(self) -> int:
+        return sum(partition.size for partition in self._partitions.values())
+
+    def clear(self) -> None:
+        """Drop all indexed vectors."""
+        with self._lock:
+            self._partitions = {}
+
+    def add(self, clause_type: str, vectors: np.ndarray, rows: List[Tuple[str, float, str, str]]) -> None:
+        """
+        Add vectors for one clause type. Each row is a
+        (chunk_text, risk_score, doc_type, filename) tuple.
+        """
+        if not clause_type or not rows:
+            return
+
+        vectors = _normalize_rows(vectors)
+        with self._lock:
+            partition = self._partitions.get(clause_type)
+            if partition is None:
+                partition = _IndexPartition(vectors.shape[1], max(self._initial_capacity, len(rows)))
+                self._partitions[clause_type] = partition
+            partition.append(vectors, rows)
+
+    def load(self, cursor) -> int:
+        """
+        Rebuild the index from rows yielded by an embeddings query cursor:
+        (chunk_type, chunk_text, risk_score, doc_type, filename, embedding_blob,
+        embedding_format, embedding_scale, embedding_vector).
+        """
+        grouped = self._group(cursor)
+        self.clear()
+        for chunk_type, (vectors, rows) in grouped.items():
+            self.add(chunk_type, stored_vectors(vectors), rows)
+        return len(self)
+
+    def extend(self, cursor) -> int:
+        """Add rows shaped like load()'s to the current index. Returns the number added."""
+        added = 0
+        for chunk_type, (vectors, rows) in self._group(cursor).items():
+            self.add(chunk_type, stored_vectors(vectors), rows)
+            added += len(rows)
+        return added
+
+    @staticmethod
+    def _group(cursor) -> Dict[str, Tuple[List, List]]:
+        grouped: Dict[str, Tuple[List, List]] = {}
+        for chunk_type, chunk_text, risk_score, doc_type, filename, *stored in cursor:
+            vectors, rows = grouped.setdefault(chunk_type, ([], []))
+            vectors.append(stored)
+            rows.append((chunk_text, float(risk_score or 0.0), doc_type, filename))
+        return grouped
+
+    def _snapshot(self, clause_type: str) -> Optional[Tuple[np.ndarray, np.ndarray, List]]:
+        """Return a consistent (matrix, risk_scores, rows) view of one partition."""
+        with self._lock:
+            partition = self._partitions.get(clause_type)
+            if partition is None or partition.size == 0:
+                return None
+            size = partition.size
+            # Rows are append-only, so the live list is safe to read up to `size`
+            return partition.matrix[:size], partition.risk_scores[:size], partition.rows
+
+    def prototypes(self, min_examples: int = 1) -> Tuple[List[str], np.ndarray]:
+        """
+        Mean direction of each clause type's stored vectors, for types with at
+        least min_examples rows. Returns (clause types, normalized prototype matrix).
+        """
+        with self._lock:
+            sums = [(clause_type, partition.vector_sum.copy())
+                    for clause_type, partition in self._partitions.items()
+                    if partition.size >= min_examples]
+        if not sums:
+            return [], np.empty((0, 0), dtype=np.float32)
+        clause_types = [clause_type for clause_type, _ in sums]
+        return clause_types, _normalize_rows(np.stack([vector_sum for _, vector_sum in sums]).astype(np.float32))
+
+    def search(self, embedding: np.ndarray, clause_type: Optional[str] = None, limit: int = 5) -> List[Dict]:
+        """Return the top `limit` most similar stored clauses, best first."""
+        query = _normalize_rows(embedding)[0]
+        clause_types = [clause_type] if clause_type else list(self._partitions)
+
+        matches = []
+        for chunk_type in clause_types:
+            snapshot = self._snapshot(chunk_type)
+            if snapshot is None:
+                continue
+            matrix, _, rows = snapshot
+
+            similarities = matrix @ query
+            k = min(limit, len(similarities))
+            top = np.argpartition(-similarities, k - 1)[:k]
+            for i in top:
+                chunk_text, risk_score, doc_type, filename = rows[i]
+                matches.append({
+                    'text': chunk_text,
+                    'similarity': float(similarities[i]),
+                    'risk_score': risk_score,
+                    'type': chunk_type,
+                    'doc_type': doc_type,
+                    'filename': filename
+                })
+
+        matches.sort(key=lambda x: x['similarity'], reverse=True)
+        return matches[:limit]
+
+    def search_batch(self, embeddings: np.ndarray, clause_type: str, limit: int = 5,
+                     block_size: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score many query vectors against one clause type's history at once.
+        Returns (similarities, risk_scores) arrays of shape (queries, k), each
+        row sorted best first; k is 0 when the clause type has no history.
+        """
+        queries = _normalize_rows(embeddings)
+        snapshot = self._snapshot(clause_type)
+        if snapshot is None:
+            empty = np.empty((len(queries), 0), dtype=np.float32)
+            return empty, empty.copy()
+        matrix, risk_scores, _ = snapshot
+
+        k = min(limit, matrix.shape[0])
+        top_similarities = np.empty((len(queries), k), dtype=np.float32)
+        top_risks = np.empty((len(queries), k), dtype=np.float32)
+
+        # Work in row blocks so the (queries x history) matrix stays bounded
+        for start in range(0, len(queries), block_size):
+            similarities = queries[start:start + block_size] @ matrix.T
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_sims = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_sims, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_similarities[start:start + block_size] = np.take_along_axis(top_sims, order, axis=1)
+            top_risks[start:start + block_size] = risk_scores[top]
+
+        return top_similarities, top_risks
+
+
+class DocumentChunks:
+    """A document's chunk texts and vectors, ready to rank against questions."""
+
+    def __init__(self, document_id: int, info: Dict, texts: List[str], vectors: np.ndarray):
+        self.document_id = document_id
+        self.info = info
+        self.texts = texts
+        self.vectors = vectors
+        self.terms = [query_terms(text) for text in texts]
+        self.token_counts = [estimate_tokens(text) for text in texts]
+
+    def rank(self, query_vector: np.ndarray, terms: set, lexical_weight: float = QUERY_LEXICAL_WEIGHT) -> np.ndarray:
+        """
+        Score every chunk against a question: cosine similarity blended with
+        the share of question terms the chunk contains.
+        """
+        scores = self.vectors @ _normalize_rows(query_vector)[0]
+        if terms and lexical_weight:
+            overlap = np.array([len(terms & chunk_terms) for chunk_terms in self.terms], dtype=np.float32) / len(terms)
+            scores = (1 - lexical_weight) * scores + lexical_weight * overlap
+        return scores
+
+
+class DocumentChunkCache:
+    """Thread-safe LRU of DocumentChunks keyed by document id."""
+
+    def __init__(self, capacity: int = QUERY_CACHE_DOCUMENTS):
+        self.capacity = capacity
+        self._entries: "OrderedDict[int, DocumentChunks]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, document_id: int) -> Optional[DocumentChunks]:
+        with self._lock:
+            entry = self._entries.get(document_id)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(document_id)
+            self._hits += 1
+            return entry
+
+    def put(self, document_id: int, entry: DocumentChunks) -> None:
+        with self._lock:
+            self._entries[document_id] = entry
+            self._entries.move_to_end(document_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'documents': len(self._entries), 'hits': self._hits, 'misses': self._misses}
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the wait limit."""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe PostgreSQL connection pool.
+    Callers block up to `timeout` seconds for a free connection; connections
+    idle longer than the health-check interval are pinged before reuse and
+    replaced if they have gone away.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, healthcheck_interval: float, **connect_kwargs):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used: Dict[int, float] = {}
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0
+        }
+
+    def _is_healthy(self, conn) -> bool:
+        """Ping a connection that has been idle for a while."""
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0.0) < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Check out a healthy connection, waiting for a free slot if needed."""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeoutError(f"No database connection available within {self.timeout}s")
+
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                with self._lock:
+                    self._stats["reconnects"] += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+        wait = time.perf_counter() - start
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["total_wait"] += wait
+            self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+        return conn
+
+    def putconn(self, conn, close: bool = False) -> None:
+        """Return a connection to the pool, discarding it if it is broken."""
+        try:
+            close = close or bool(conn.closed)
+            if not close and conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=close)
+        if not close:
+            self._last_used[id(conn)] = time.monotonic()
+
+        with self._lock:
+            self._stats["in_use"] -= 1
+        self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool size, current usage and checkout latency figures."""
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = stats.pop("checkouts")
+        total_wait = stats.pop("total_wait")
+        return {
+            "max_size": self.maxconn,
+            "in_use": stats["in_use"],
+            "available": self.maxconn - stats["in_use"],
+            "checkouts": checkouts,
+            "timeouts": stats["timeouts"],
+            "reconnects": stats["reconnects"],
+            "wait_timeout_s": self.timeout,
+            "avg_checkout_ms": round(total_wait / checkouts * 1000, 3) if checkouts else 0.0,
+            "max_checkout_ms": round(stats["max_wait"] * 1000, 3)
+        }
+
+    def closeall(self) -> None:
+        """Close every pooled connection."""
+        self._pool.closeall()
+
+
 class DatabaseManager:
     def __init__(self):
-        """Initialize database connection and create tables if they don't exist."""
-        self.conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        self.create_tables()
-    
-    def create_tables(self):
-        """Create necessary tables if they don't exist."""
-        with self.conn.cursor() as cursor:
-            # Documents table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS documents (
-                    id SERIAL PRIMARY KEY,
-                    filename TEXT NOT NULL,
-                    doc_type TEXT NOT NULL,
-                    upload_date TIMESTAMP NOT NULL,
-                    full_text TEXT NOT NULL,
-                    metadata JSONB
+        """
+        Set up the database manager. The connection pool, schema check and
+        clause index are initialized on first use (or from a warm-up hook).
+        """
+        self._pool = None
+        self._local = threading.local()
+        self._init_lock = threading.RLock()
+        self._initialized = False
+        self.clause_index = ClauseVectorIndex()
+        # Per-document chunk matrices for question answering, reused across questions
+        self.document_chunks = DocumentChunkCache()
+        self._index_lock = threading.Lock()
+        self._index_loaded = False
+        # Newest embedding id in the index, plus the ids already indexed within
+        # CLAUSE_INDEX_REFRESH_OVERLAP of it, for incremental refreshes
+        self._index_max_id = 0
+        self._index_recent_ids: set = set()
+        self._index_next_refresh = 0.0
+    
+    @property
+    def pool(self) -> ConnectionPool:
+        """The connection pool, opened on first use."""
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        DB_POOL_MIN,
+                        DB_POOL_MAX,
+                        timeout=DB_POOL_TIMEOUT,
+                        healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+                        dbname=DB_NAME,
+                        user=DB_USER,
+                        password=DB_PASSWORD,
+                        host=DB_HOST,
+                        port=DB_PORT
+                    )
+        return self._pool
+    
+    def initialize(self) -> None:
+        """Check the schema version (migrating first if DB_AUTO_MIGRATE is set). Runs once per process."""
+        if self._initialized:
+            return
+        with self._init_lock:
+            # The checks below check out a connection themselves; don't recurse into them
+            if self._initialized or getattr(self._local, 'initializing', False):
+                return
+            self._local.initializing = True
+            try:
+                if DB_AUTO_MIGRATE:
+                    self.migrate()
+                self.check_schema()
+                self._initialized = True
+            finally:
+                self._local.initializing = False
+    
+    def ensure_clause_index(self) -> None:
+        """
+        Load the in-memory clause index on first use, then top it up with rows
+        stored by other processes at most every CLAUSE_INDEX_REFRESH seconds.
+        """
+        if self._index_loaded:
+            # Not from inside a transaction, which could see its own uncommitted rows
+            nested = getattr(self._local, 'conn', None) is not None
+            if time.monotonic() >= self._index_next_refresh and not nested:
+                # One thread refreshes; the others search the current index
+                if self._index_lock.acquire(blocking=False):
+                    try:
+                        if time.monotonic() >= self._index_next_refresh:
+                            self._refresh_clause_index()
+                    finally:
+                        self._index_lock.release()
+            return
+        with self._index_lock:
+            if not self._index_loaded:
+                self.rebuild_clause_index()
+                self._index_loaded = True
+    
+    @contextmanager
+    def connection(self, shared: bool = True):
+        """
+        Check a pooled connection out for the duration of a with-block.
+        Commits on success and rolls back on error. Nested use in the same
+        thread reuses the outer connection and leaves commit to the outer block.
+        
+        Pass shared=False for a connection held across the yields of a
+        generator (e.g. a streamed response): it gets its own connection that
+        isn't bound to the thread, so unrelated work on the thread can't pick it up.
+        """
+        conn = getattr(self._local, 'conn', None) if shared else None
+        if conn is not None:
+            yield conn
+            return
+        
+        self.initialize()
+        conn = self.pool.getconn()
+        if shared:
+            self._local.conn = conn
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            if shared:
+                self._local.conn = None
+            self.pool.putconn(conn, close=broken)
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Expose connection pool statistics for monitoring."""
+        return self.pool.stats()
+    
+    def rebuild_clause_index(self) -> int:
+        """Load every typed embedding into the in-memory clause index."""
+        self._index_max_id = 0
+        self._index_recent_ids = set()
+        with self.connection() as conn, conn.cursor(name='clause_index_load') as cursor:
+            cursor.itersize = 10000
+            cursor.execute(
+                """
+                SELECT e.id, e.chunk_type, e.chunk_text, e.risk_score, d.doc_type, d.filename,
+                       e.embedding_blob, e.embedding_format, e.embedding_scale, e.embedding_vector
+                FROM embeddings e
+                JOIN documents d ON e.document_id = d.id
+                WHERE e.chunk_type IS NOT NULL
+                ORDER BY e.id
+                """
+            )
+            count = self.clause_index.load(self._track_index_rows(cursor))
+        self._index_next_refresh = time.monotonic() + CLAUSE_INDEX_REFRESH
+        print(f"Clause index loaded: {count} embeddings")
+        return count
+    
+    def _refresh_clause_index(self) -> int:
+        """Add typed embeddings stored since the last load. Call with _index_lock held."""
+        floor = max(0, self._index_max_id - CLAUSE_INDEX_REFRESH_OVERLAP)
+        added = 0
+        with self.connection() as conn, conn.cursor() as cursor:
+            # Ids first: most of the overlap window is already indexed, so only
+            # the rows that aren't get their text and vectors fetched
+            cursor.execute(
+                'SELECT id FROM embeddings WHERE chunk_type IS NOT NULL AND id > %s',
+                (floor,)
+            )
+            missing = sorted(row[0] for row in cursor.fetchall() if row[0] not in self._index_recent_ids)
+            if missing:
+                cursor.execute(
+                    """
+                    SELECT e.id, e.chunk_type, e.chunk_text, e.risk_score, d.doc_type, d.filename,
+                           e.embedding_blob, e.embedding_format, e.embedding_scale, e.embedding_vector
+                    FROM embeddings e
+                    JOIN documents d ON e.document_id = d.id
+                    WHERE e.id = ANY(%s)
+                    ORDER BY e.id
+                    """,
+                    (missing,)
                 )
-            ''')
+                added = self.clause_index.extend(self._track_index_rows(cursor))
+        self._index_next_refresh = time.monotonic() + CLAUSE_INDEX_REFRESH
+        return added
+    
+    def _track_index_rows(self, rows) -> Iterator[tuple]:
+        """Strip the id from each embeddings row, skipping rows already indexed."""
+        for row in rows:
+            embedding_id = row[0]
+            if embedding_id in self._index_recent_ids:
+                continue
+            self._index_recent_ids.add(embedding_id)
+            self._index_max_id = max(self._index_max_id, embedding_id)
+            if len(self._index_recent_ids) > 2 * CLAUSE_INDEX_REFRESH_OVERLAP:
+                self._prune_index_ids()
+            yield row[1:]
+        self._prune_index_ids()
+    
+    def _prune_index_ids(self) -> None:
+        floor = self._index_max_id - CLAUSE_INDEX_REFRESH_OVERLAP
+        self._index_recent_ids = {i for i in self._index_recent_ids if i > floor}
+    
+    def check_schema(self) -> int:
+        """Fail unless the database schema is at the version this code expects (see migrations.py)."""
+        with self.connection() as conn:
+            return check_version(conn)
+    
+    def migrate(self, target: Optional[int] = None) -> List[int]:
+        """Apply pending schema migrations on a pooled connection."""
+        # Straight from the pool: connection() would check the schema version first
+        conn = self.pool.getconn()
+        try:
+            return migrate_schema(conn, target)
+        finally:
+            self.pool.putconn(conn)
+    
+    def _insert_document(self, cursor, filename: str, doc_type: str, full_text: str, metadata: Dict = None,
+                         user_id: Optional[int] = None, content_hash: Optional[str] = None,
+                         storage_path: Optional[str] = None) -> int:
+        """Insert a document row on the given cursor and return its id (no commit)."""
+        cursor.execute(
+            """
+            INSERT INTO documents (filename, doc_type, upload_date, full_text, metadata, user_id, content_hash, storage_path)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+            """,
+            (filename, doc_type, datetime.now(), full_text, json.dumps(metadata or {}), user_id, content_hash, storage_path)
+        )
+        return cursor.fetchone()[0]
+    
+    def insert_document(self, filename: str, doc_type: str, full_text: str, metadata: Dict = None,
+                        user_id: Optional[int] = None) -> int:
+        """Insert document data and return document id."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            document_id = self._insert_document(cursor, filename, doc_type, full_text, metadata, user_id)
+            return document_id
+    
+    @staticmethod
+    def _stage_embedding_rows(document_id: int, chunks_with_embeddings: List[Dict]) -> Tuple[List[tuple], List[Dict], List[str]]:
+        """
+        Validate chunks before a bulk write.
+        Returns (rows to insert, accepted chunks, per-row error messages).
+        Untyped chunks are kept (chunk_type NULL) so question answering can
+        retrieve from the whole document; the clause index skips them.
+        """
+        rows, accepted, errors = [], [], []
+        dim = None
+        
+        for i, chunk in enumerate(chunks_with_embeddings):
+            try:
+                embedding = np.asarray(chunk.get('embedding'), dtype=np.float32).ravel()
+            except (TypeError, ValueError):
+                embedding = np.empty(0, dtype=np.float32)
+            risk_score = chunk.get('risk_score', 0.0)
+            dim = dim or embedding.size
             
-            # Check if embeddings table exists
-            cursor.execute('''
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'embeddings'
-                )
-            ''')
+            if not chunk.get('text'):
+                errors.append(f"chunk {i}: empty text")
+            elif chunk.get('embedding') is None:
+                errors.append(f"chunk {i}: missing embedding")
+            elif embedding.size == 0 or embedding.size != dim:
+                errors.append(f"chunk {i}: embedding has {embedding.size} dimensions, expected {dim}")
+            elif not np.all(np.isfinite(embedding)):
+                errors.append(f"chunk {i}: embedding contains NaN or infinite values")
+            elif not isinstance(risk_score, (int, float)) or not math.isfinite(risk_score):
+                errors.append(f"chunk {i}: invalid risk score {risk_score!r}")
+            else:
+                blob, fmt, scale = encode_embedding(embedding)
+                rows.append((document_id, chunk['text'], blob, fmt, scale, chunk.get('type'), float(risk_score)))
+                accepted.append(chunk)
+        
+        return rows, accepted, errors
+    
+    @staticmethod
+    def _stage_risk_rows(document_id: int, analyses: List[Dict]) -> Tuple[List[tuple], List[str]]:
+        """Validate risk analyses before a bulk write. Returns (rows, per-row error messages)."""
+        rows, errors = [], []
+        analysis_date = datetime.now()
+        
+        for i, analysis in enumerate(analyses):
+            risk_score = analysis.get('risk_score')
             
-            table_exists = cursor.fetchone()[0]
+            if not analysis.get('clause_type') or not analysis.get('clause_text'):
+                errors.append(f"analysis {i}: missing clause type or text")
+            elif not isinstance(risk_score, (int, float)) or not math.isfinite(risk_score):
+                errors.append(f"analysis {i}: invalid risk score {risk_score!r}")
+            else:
+                rows.append((
+                    document_id,
+                    analysis['clause_type'],
+                    analysis['clause_text'],
+                    float(risk_score),
+                    analysis.get('risk_explanation', ''),
+                    analysis_date
+                ))
+        
+        return rows, errors
+    
+    @staticmethod
+    def _write_embedding_rows(cursor, rows: List[tuple]) -> None:
+        """Write staged embedding rows with multi-row INSERTs."""
+        execute_values(
+            cursor,
+            """
+            INSERT INTO embeddings (document_id, chunk_text, embedding_blob, embedding_format, embedding_scale, chunk_type, risk_score)
+            VALUES %s
+            """,
+            rows,
+            page_size=500
+        )
+    
+    @staticmethod
+    def _write_risk_rows(cursor, rows: List[tuple]) -> None:
+        """Write staged risk analysis rows with multi-row INSERTs."""
+        execute_values(
+            cursor,
+            "INSERT INTO risk_analysis (document_id, clause_type, clause_text, risk_score, risk_explanation, analysis_date) VALUES %s",
+            rows,
+            page_size=500
+        )
+    
+    @staticmethod
+    def _report_rejected(kind: str, errors: List[str]) -> None:
+        """Print per-row validation failures."""
+        for error in errors:
+            print(f"Rejected {kind} row - {error}")
+    
+    @staticmethod
+    def _update_risk_aggregates(cursor, document_id: int) -> None:
+        """Recompute a document's overall_risk_score (mean clause risk) and clause_count from risk_analysis."""
+        cursor.execute(
+            """
+            UPDATE documents d SET (overall_risk_score, clause_count) = (
+                SELECT COALESCE(AVG(r.risk_score), 0), COUNT(*) FROM risk_analysis r WHERE r.document_id = d.id
+            )
+            WHERE d.id = %s
+            """,
+            (document_id,)
+        )
+    
+    def insert_embeddings(self, document_id: int, chunks_with_embeddings: List[Dict]) -> None:
+        """Insert text chunks and their packed embeddings in one transaction."""
+        rows, accepted, errors = self._stage_embedding_rows(document_id, chunks_with_embeddings)
+        self._report_rejected("embedding", errors)
+        
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                self._write_embedding_rows(cursor, rows)
+        
+        print(f"Embeddings inserted: {len(rows)}, skipped: {len(chunks_with_embeddings) - len(rows)}")
+        self._index_committed_chunks(document_id, accepted)
+    
+    def insert_risk_analysis(self, document_id: int, analyses: List[Dict]) -> None:
+        """Insert risk analysis results in one transaction."""
+        rows, errors = self._stage_risk_rows(document_id, analyses)
+        self._report_rejected("risk analysis", errors)
+        
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                self._write_risk_rows(cursor, rows)
+                self._update_risk_aggregates(cursor, document_id)
+    
+    def save_document_analysis(self, filename: str, doc_type: str, full_text: str, metadata: Dict,
+                               chunks_with_embeddings: List[Dict], risk_analyses: List[Dict],
+                               user_id: Optional[int] = None, content_hash: Optional[str] = None,
+                               storage_path: Optional[str] = None) -> int:
+        """
+        Write a document, its embeddings and its risk analyses in a single
+        transaction and return the new document id.
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                document_id = self._insert_document(
+                    cursor, filename, doc_type, full_text, metadata,
+                    user_id=user_id, content_hash=content_hash, storage_path=storage_path
+                )
+                
+                embedding_rows, accepted, embedding_errors = self._stage_embedding_rows(document_id, chunks_with_embeddings)
+                risk_rows, risk_errors = self._stage_risk_rows(document_id, risk_analyses)
+                self._report_rejected("embedding", embedding_errors)
+                self._report_rejected("risk analysis", risk_errors)
+                
+                self._write_embedding_rows(cursor, embedding_rows)
+                self._write_risk_rows(cursor, risk_rows)
+                self._update_risk_aggregates(cursor, document_id)
+        
+        print(f"Saved document {document_id}: {len(embedding_rows)} embeddings, {len(risk_rows)} risk analyses")
+        self._index_committed_chunks(document_id, accepted)
+        return document_id
+    
+    def _index_committed_chunks(self, document_id: int, chunks: List[Dict]) -> None:
+        """Bring freshly committed chunks into the in-memory clause index."""
+        if any(chunk.get('type') for chunk in chunks):
+            self.refresh_clause_index()
+    
+    def refresh_clause_index(self) -> None:
+        """
+        Add committed embeddings to the clause index now rather than at the
+        next periodic refresh. Does nothing inside an outer connection() block:
+        its rows aren't committed yet and may still be rolled back, so the
+        outermost caller should call this again after it commits.
+        """
+        # An index that hasn't been loaded yet will pick these rows up from the table
+        if not self._index_loaded or getattr(self._local, 'conn', None) is not None:
+            return
+        # Read back by id, so the periodic refresh won't add them a second time
+        with self._index_lock:
+            self._refresh_clause_index()
+    
+    def find_document_by_hash(self, content_hash: str, user_id: Optional[int] = None) -> Optional[Tuple[int, Optional[int]]]:
+        """
+        Find an analyzed document with identical content, preferring one the
+        given user already owns. Returns (document_id, owner_user_id) or None.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, user_id FROM documents
+                WHERE content_hash = %s
+                ORDER BY (user_id IS NOT DISTINCT FROM %s) DESC, id
+                LIMIT 1
+                """,
+                (content_hash, user_id)
+            )
+            return cursor.fetchone()
+
+    def lock_upload(self, user_id: Optional[int], content_hash: str) -> None:
+        """
+        Take a transaction-level advisory lock on one user's upload of this
+        content. Call inside an outer connection() block: concurrent uploads of
+        the same file wait here until that block commits or rolls back.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f"upload:{user_id}:{content_hash}",))
+
+    def set_storage_path(self, document_id: int, storage_path: str) -> None:
+        """Record where a document's file lives on disk."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                'UPDATE documents SET storage_path = %s WHERE id = %s',
+                (storage_path, document_id)
+            )
+
+    def clone_document(self, document_id: int, user_id: Optional[int], filename: str) -> int:
+        """
+        Copy an analyzed document and its risk analyses to another user without
+        re-running the analysis. Embeddings are not copied, so the clause
+        history used for scoring isn't skewed by duplicates; metadata.cloned_from
+        points at the original, whose chunks serve questions about the copy.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO documents (filename, doc_type, upload_date, full_text, metadata, user_id, content_hash, storage_path,
+                                       overall_risk_score, clause_count)
+                SELECT %s, doc_type, %s, full_text,
+                       COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('cloned_from', COALESCE((metadata->>'cloned_from')::int, id)),
+                       %s, content_hash, storage_path, overall_risk_score, clause_count
+                FROM documents WHERE id = %s
+                RETURNING id
+                """,
+                (filename, datetime.now(), user_id, document_id)
+            )
+            clone_id = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                INSERT INTO analysis_snapshots (document_id, version, format_version, analysis, created_at)
+                SELECT %s, version, format_version, analysis, created_at
+                FROM analysis_snapshots WHERE document_id = %s
+                """,
+                (clone_id, document_id)
+            )
+            cursor.execute(
+                """
+                INSERT INTO risk_analysis (document_id, clause_type, clause_text, risk_score, risk_explanation, analysis_date)
+                SELECT %s, clause_type, clause_text, risk_score, risk_explanation, analysis_date
+                FROM risk_analysis WHERE document_id = %s
+                ORDER BY id
+                """,
+                (clone_id, document_id)
+            )
+            return clone_id
+    
+    def get_document_chunks(self, document_id: int) -> Optional[Dict]:
+        """
+        Load a document's stored chunks for question answering: its info, chunk
+        texts and normalized vectors in document order. Clones read the
+        original's chunks. Documents analyzed before every chunk was stored
+        come back with their full_text (and no vectors) to be chunked again.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT filename, doc_type, (metadata->>'chunks')::int,
+                       COALESCE((metadata->>'cloned_from')::int, id)
+                FROM documents WHERE id = %s
+                """,
+                (document_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            filename, doc_type, expected_chunks, source_id = row
             
-            if not table_exists:
-                # Create the table if it doesn't exist
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS embeddings (
-                        id SERIAL PRIMARY KEY,
-                        document_id INTEGER REFERENCES documents(id),
-                        chunk_text TEXT NOT NULL,
-                        embedding_vector FLOAT[] NOT NULL,
-                        chunk_type TEXT,
-                        risk_score FLOAT
-                    )
-                ''')
-                self.conn.commit()
-            else:
-                # Check column type if table exists
-                cursor.execute('''
-                    SELECT data_type 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'embeddings' AND column_name = 'embedding_vector'
-                ''')
-                
-                column_type = cursor.fetchone()
-                
-                if column_type and column_type[0] == 'bytea':
-                    print("Warning: Found embeddings table with bytea type. Migration needed.")
-                    print("Please run the migration script separately.")
-                    # We don't automatically migrate here to avoid data loss
-
-            # Risk analysis table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS risk_analysis (
-                    id SERIAL PRIMARY KEY,
-                    document_id INTEGER REFERENCES documents(id),
-                    clause_type TEXT NOT NULL,
-                    clause_text TEXT NOT NULL,
-                    risk_score FLOAT NOT NULL,
-                    risk_explanation TEXT,
-                    analysis_date TIMESTAMP NOT NULL
-                )
-            ''')
+            cursor.execute(
+                """
+                SELECT chunk_text, embedding_blob, embedding_format, embedding_scale, embedding_vector
+                FROM embeddings WHERE document_id = %s ORDER BY id
+                """,
+                (source_id,)
+            )
+            rows = cursor.fetchall()
             
-            self.conn.commit()
+            full_text = None
+            if not rows or (expected_chunks is not None and len(rows) < expected_chunks):
+                cursor.execute("SELECT full_text FROM documents WHERE id = %s", (document_id,))
+                full_text = cursor.fetchone()[0]
+        
+        return {
+            'info': {'filename': filename, 'doc_type': doc_type},
+            'texts': [row[0] for row in rows],
+            'vectors': _normalize_rows(stored_vectors([row[1:] for row in rows])) if rows and full_text is None else None,
+            'full_text': full_text
+        }
     
-    def insert_document(self, filename: str, doc_type: str, full_text: str, metadata: Dict = None) -> int:
-        """Insert document data and return document id."""
-        with self.conn.cursor() as cursor:
+    def save_analysis_snapshot(self, document_id: int, analysis: Dict) -> int:
+        """Store a complete analysis result as the document's next snapshot version. Returns the version."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            # Concurrent saves for the same document (e.g. two first views of a legacy
+            # one) take turns here, so they can't both pick the same next version
+            cursor.execute('SELECT id FROM documents WHERE id = %s FOR UPDATE', (document_id,))
             cursor.execute(
-                "INSERT INTO documents (filename, doc_type, upload_date, full_text, metadata) VALUES (%s, %s, %s, %s, %s) RETURNING id",
-                (filename, doc_type, datetime.now(), full_text, json.dumps(metadata or {}))
+                """
+                INSERT INTO analysis_snapshots (document_id, version, format_version, analysis, created_at)
+                SELECT %s, COALESCE(MAX(version), 0) + 1, %s, %s, %s
+                FROM analysis_snapshots WHERE document_id = %s
+                RETURNING version
+                """,
+                (document_id, SNAPSHOT_FORMAT_VERSION, json.dumps(analysis, default=_json_default), datetime.now(), document_id)
             )
-            document_id = cursor.fetchone()[0]
-            self.conn.commit()
-            return document_id
+            version = cursor.fetchone()[0]
+            return version
     
-    def insert_embeddings(self, document_id: int, chunks_with_embeddings: List[Dict]) -> None:
-        """Insert text chunks and their embeddings as float arrays."""
-        # Count for reporting
-        successful = 0
-        skipped = 0
+    def get_analysis_snapshot(self, document_id: int, user_id: Optional[int]) -> Optional[Tuple[str, datetime, Optional[Dict], bool]]:
+        """
+        The latest analysis snapshot of a document the user owns, with one
+        indexed lookup. Returns (filename, upload_date, analysis, is_clone)
+        where analysis is None if the document has no snapshot yet, or None if
+        the user has no such document. A clone also sees its original's
+        snapshots, so one cloned before the original's snapshot was written
+        still gets it.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT d.filename, d.upload_date, s.analysis, d.metadata ? 'cloned_from'
+                FROM documents d
+                LEFT JOIN LATERAL (
+                    SELECT analysis FROM analysis_snapshots
+                    WHERE document_id IN (d.id, (d.metadata->>'cloned_from')::int)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 1
+                ) s ON TRUE
+                WHERE d.id = %s AND d.user_id = %s
+                """,
+                (document_id, user_id)
+            )
+            return cursor.fetchone()
+    
+    def iter_clause_export(self, user_id: Optional[int], document_ids: Optional[List[int]] = None,
+                           batch_size: int = 2000) -> Iterator[List[tuple]]:
+        """
+        Stream scored clauses, with their document's details, in batches through
+        a server-side cursor so memory stays flat however many rows there are.
+        Rows are (document_id, filename, doc_type, upload_date, clause_type,
+        clause_text, risk_score, risk_explanation, analysis_date), in document
+        order. user_id None exports every user's documents.
+        """
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("d.user_id = %s")
+            params.append(user_id)
+        if document_ids:
+            conditions.append("d.id = ANY(%s)")
+            params.append(list(document_ids))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
         
-        for chunk in chunks_with_embeddings:
-            try:
-                # Skip chunks without identified types
-                if not chunk.get('type'):
-                    skipped += 1
-                    continue
-                    
-                # Convert numpy array to Python list
-                if isinstance(chunk['embedding'], np.ndarray):
-                    embedding_list = chunk['embedding'].tolist()
-                else:
-                    embedding_list = chunk['embedding']
-                
-                # Use a transaction for each insertion to prevent entire batch failure
-                with self.conn.cursor() as cursor:
-                    cursor.execute(
-                        """
-                        INSERT INTO embeddings 
-                        (document_id, chunk_text, embedding_vector, chunk_type, risk_score) 
-                        VALUES (%s, %s, %s, %s, %s)
-                        """,
-                        (
-                            document_id, 
-                            chunk['text'], 
-                            embedding_list,
-                            chunk.get('type'), 
-                            chunk.get('risk_score', 0.0)
-                        )
-                    )
-                    self.conn.commit()
-                    successful += 1
-                    
-            except Exception as e:
-                # Log the error but continue processing other chunks
-                self.conn.rollback()
-                print(f"Error inserting embedding: {str(e)}")
-                skipped += 1
+        with self.connection(shared=False) as conn, conn.cursor(name='clause_export') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(
+                f"""
+                SELECT d.id, d.filename, d.doc_type, d.upload_date, r.clause_type, r.clause_text,
+                       r.risk_score, r.risk_explanation, r.analysis_date
+                FROM risk_analysis r
+                JOIN documents d ON r.document_id = d.id
+                {where}
+                ORDER BY d.id, r.id
+                """,
+                params
+            )
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+    
+    def list_user_documents(self, user_id: int, limit: Optional[int] = None,
+                            after: Optional[Tuple[datetime, int]] = None, doc_type: Optional[str] = None,
+                            risk_level: Optional[str] = None) -> List[tuple]:
+        """
+        A user's documents, newest first, as (id, filename, doc_type,
+        upload_date, overall_risk_score, clause_count). Pages are keyed on
+        (upload_date, id): pass the last row's pair as after for the next one.
+        risk_level keeps documents whose overall risk falls in that band.
+        """
+        conditions, params = ["user_id = %s"], [user_id]
+        if after is not None:
+            conditions.append("(upload_date, id) < (%s, %s)")
+            params.extend(after)
+        if doc_type:
+            conditions.append("doc_type = %s")
+            params.append(doc_type)
+        if risk_level:
+            lower, upper = risk_band(risk_level)
+            if lower is not None:
+                conditions.append("COALESCE(overall_risk_score, 0) >= %s")
+                params.append(lower)
+            if upper is not None:
+                conditions.append("COALESCE(overall_risk_score, 0) < %s")
+                params.append(upper)
+        limit_clause = ""
+        if limit is not None:
+            limit_clause = "LIMIT %s"
+            params.append(limit)
         
-        print(f"Embeddings inserted: {successful}, skipped: {skipped}")
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT id, filename, doc_type, upload_date, overall_risk_score, clause_count
+                FROM documents
+                WHERE {' AND '.join(conditions)}
+                ORDER BY upload_date DESC, id DESC
+                {limit_clause}
+                """,
+                params
+            )
+            return cursor.fetchall()
     
-    def insert_risk_analysis(self, document_id: int, analyses: List[Dict]) -> None:
-        """Insert risk analysis results."""
-        with self.conn.cursor() as cursor:
-            for analysis in analyses:
-                cursor.execute(
-                    "INSERT INTO risk_analysis (document_id, clause_type, clause_text, risk_score, risk_explanation, analysis_date) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (
-                        document_id,
-                        analysis['clause_type'],
-                        analysis['clause_text'],
-                        analysis['risk_score'],
-                        analysis.get('risk_explanation', ''),
-                        datetime.now()
-                    )
-                )
-            self.conn.commit()
+    def record_query(self, document_id: int, user_id: Optional[int], query: str, answer: str,
+                     streamed: bool = False) -> None:
+        """Store a question and the answer it got."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO document_queries (document_id, user_id, query, answer, streamed, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """,
+                (document_id, user_id, query, answer, streamed, datetime.now())
+            )
+    
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """The id, name and email of a user, or None."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT id, name, email FROM users WHERE id = %s', (user_id,))
+            row = cursor.fetchone()
+        return {'id': row[0], 'name': row[1], 'email': row[2]} if row else None
+    
+    def revoke_token(self, jti: str, user_id: Optional[int], expires_at: datetime) -> None:
+        """Add a token id to the revocation list."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO revoked_tokens (jti, user_id, expires_at, revoked_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (jti) DO NOTHING
+                """,
+                (jti, user_id, expires_at, datetime.now())
+            )
+            # Expired revocations no longer matter
+            cursor.execute('DELETE FROM revoked_tokens WHERE expires_at < %s', (datetime.now(),))
+    
+    def get_revoked_tokens(self, since: Optional[datetime] = None) -> List[Tuple[str, datetime, datetime]]:
+        """(jti, expires_at, revoked_at) of unexpired revocations, only those made after since if given."""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT jti, expires_at, revoked_at FROM revoked_tokens
+                WHERE expires_at >= %s AND (%s::timestamp IS NULL OR revoked_at > %s)
+                """,
+                (datetime.now(), since, since)
+            )
+            return cursor.fetchall()
     
     def get_similar_clauses(self, embedding: np.ndarray, clause_type: Optional[str] = None, limit: int = 5) -> List[Dict]:
         """Retrieve similar clauses based on embedding similarity."""
-        with self.conn.cursor() as cursor:
-            if clause_type:
-                cursor.execute(
-                    """
-                    SELECT e.chunk_text, e.risk_score, d.doc_type, d.filename, e.embedding_vector
-                    FROM embeddings e
-                    JOIN documents d ON e.document_id = d.id
-                    WHERE e.chunk_type = %s
-                    """,
-                    (clause_type,)
-                )
-            else:
-                cursor.execute(
-                    """
-                    SELECT e.chunk_text, e.risk_score, e.chunk_type, d.doc_type, d.filename, e.embedding_vector
-                    FROM embeddings e
-                    JOIN documents d ON e.document_id = d.id
-                    """
-                )
-            
-            results = cursor.fetchall()
-            
-            if not results:
-                return []
-            
-            # Get all embeddings and compute similarity
-            similar_clauses = []
-            for result in results:
-                # Unpack the result based on whether a clause_type was provided
-                if clause_type:
-                    chunk_text, risk_score, doc_type, filename, db_embedding_array = result
-                    chunk_type = clause_type
-                else:
-                    chunk_text, risk_score, chunk_type, doc_type, filename, db_embedding_array = result
-                
-                # Convert PostgreSQL array to numpy array
-                db_embedding = np.array(db_embedding_array, dtype=np.float32)
-                
-                # Calculate similarity
-                similarity = cosine_similarity([embedding], [db_embedding])[0][0]
-                
-                similar_clauses.append({
-                    'text': chunk_text,
-                    'similarity': similarity,
-                    'risk_score': risk_score,
-                    'type': chunk_type,
-                    'doc_type': doc_type,
-                    'filename': filename
-                })
-            
-            # Sort by similarity and return top matches
-            similar_clauses.sort(key=lambda x: x['similarity'], reverse=True)
-            return similar_clauses[:limit]
+        self.ensure_clause_index()
+        return self.clause_index.search(embedding, clause_type=clause_type, limit=limit)
+    
+    def get_similar_clauses_batch(self, embeddings: np.ndarray, clause_type: str, limit: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """Retrieve neighbour similarities and risk scores for many chunks of one clause type."""
+        self.ensure_clause_index()
+        return self.clause_index.search_batch(embeddings, clause_type=clause_type, limit=limit)
+    
+    def get_clause_prototypes(self, min_examples: int = CLAUSE_PROTOTYPE_MIN_EXAMPLES) -> Tuple[List[str], np.ndarray]:
+        """Per-clause-type prototype vectors built from the labeled embeddings history."""
+        self.ensure_clause_index()
+        return self.clause_index.prototypes(min_examples)
     
     def get_average_risk_scores(self) -> Dict[str, float]:
         """Retrieve average risk scores by clause type from historical data."""
-        with self.conn.cursor() as cursor:
+        with self.connection() as conn, conn.cursor() as cursor:
             cursor.execute(
                 """
                 SELECT clause_type, AVG(risk_score) as avg_score
@@ -282,9 +1776,9 @@ class DatabaseManager:
             return {clause_type: avg_score for clause_type, avg_score in results}
     
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Close all pooled database connections."""
+        if self._pool is not None:
+            self._pool.closeall()
 
 
 class ContractAnalyzer:
@@ -328,13 +1822,7 @@ Generate a professional summary in 3-4 sentences. Mention document type, purpose
 """
             
             # Call Together AI
-            response = together_client.chat.completions.create(
-                model=TOGETHER_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500
-            )
-            
-            summary_text = response.choices[0].message.content.strip()
+            summary_text = create_chat_completion(prompt, max_tokens=500).strip()
             
             # Format the final summary with risk information
             if risk_counts['high'] > 0 or risk_counts['medium'] > 0:
@@ -388,41 +1876,117 @@ Generate a professional summary in 3-4 sentences. Mention document type, purpose
     
     def extract_text_from_image(self, image_path: str) -> str:
         """Extract text from image using OCR."""
+        import cv2
+        
         # Read image
         img = cv2.imread(image_path)
         if img is None:
             raise ValueError(f"Cannot read image file: {image_path}")
         
-        # Preprocessing for better OCR
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+        # Preprocessing and OCR
+        return _ocr_image(img)
+    
+    def _iter_pdf_text_layer(self, pdf_path: str) -> Iterator[str]:
+        """
+        Yield the embedded text of each PDF page in order. Large PDFs are
+        split into page ranges extracted across the shared process pool.
+        """
+        import PyPDF2
+        
+        with open(pdf_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            page_count = len(reader.pages)
+            
+            if page_count < PDF_PARALLEL_MIN_PAGES or EXTRACTION_WORKERS <= 1:
+                for page in reader.pages:
+                    yield page.extract_text() or ""
+                return
+        
+        pool = get_process_pool()
+        futures = [
+            pool.submit(_extract_pdf_page_range, pdf_path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)
+        ]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            # Stop queued work if the consumer stops early
+            for future in futures:
+                future.cancel()
+    
+    def iter_pdf_pages(self, pdf_path: str) -> Iterator[str]:
+        """
+        Yield the text of each PDF page in order. Pages without a usable text
+        layer (scans) are rasterized and OCRed across the process pool while
+        extraction of the following pages continues.
+        """
+        if not PDF2IMAGE_AVAILABLE:
+            yield from self._iter_pdf_text_layer(pdf_path)
+            return
+        
+        pending = deque()
+        
+        def resolve(item) -> str:
+            if isinstance(item, str):
+                return item
+            text, future = item
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"OCR failed for a scanned page, keeping its text layer: {str(e)}")
+                return text
         
-        # Apply OCR
-        text = pytesseract.image_to_string(gray)
-        return text
+        try:
+            for page_index, text in enumerate(self._iter_pdf_text_layer(pdf_path)):
+                if _needs_ocr(text):
+                    if EXTRACTION_WORKERS > 1:
+                        future = get_process_pool().submit(_ocr_pdf_page, pdf_path, page_index, OCR_DPI, OCR_CACHE_DIR)
+                    else:
+                        future = Future()
+                        try:
+                            future.set_result(_ocr_pdf_page(pdf_path, page_index, OCR_DPI, OCR_CACHE_DIR))
+                        except Exception as e:
+                            future.set_exception(e)
+                    pending.append((text, future))
+                else:
+                    pending.append(text)
+                
+                # Yield every leading page that is already finished
+                while pending and (isinstance(pending[0], str) or pending[0][1].done()):
+                    yield resolve(pending.popleft())
+            
+            while pending:
+                yield resolve(pending.popleft())
+        finally:
+            for item in pending:
+                if not isinstance(item, str):
+                    item[1].cancel()
+    
+    def extract_pages_from_pdf(self, pdf_path: str) -> List[str]:
+        """Extract the text of every PDF page, keeping page boundaries."""
+        return list(self.iter_pdf_pages(pdf_path))
     
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract text from PDF."""
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page_num in range(len(reader.pages)):
-                text += reader.pages[page_num].extract_text()
-        # print(text)   
-        return text
+        return PAGE_SEPARATOR.join(self.extract_pages_from_pdf(pdf_path))
     
-    def extract_text(self, file_path: str) -> str:
-        """Extract text from a document based on file type."""
+    def extract_pages(self, file_path: str) -> List[str]:
+        """Extract a document's text page by page based on file type (images are one page)."""
         _, file_ext = os.path.splitext(file_path)
         file_ext = file_ext.lower()
         
         if file_ext in ['.jpg', '.jpeg', '.png']:
-            return self.extract_text_from_image(file_path)
+            return [self.extract_text_from_image(file_path)]
         elif file_ext == '.pdf':
-            return self.extract_text_from_pdf(file_path)
+            return self.extract_pages_from_pdf(file_path)
         else:
             raise ValueError(f"Unsupported file format: {file_ext}")
     
+    def extract_text(self, file_path: str) -> str:
+        """Extract text from a document based on file type."""
+        return PAGE_SEPARATOR.join(self.extract_pages(file_path))
+    
     def detect_document_type(self, text: str) -> str:
         """
         Detect document type using Together AI instead of simple regex.
@@ -443,13 +2007,7 @@ Document text excerpt (first 1000 characters):
 Classification:"""
             
             # Call Together AI
-            response = together_client.chat.completions.create(
-                model=TOGETHER_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=10
-            )
-            
-            classification = response.choices[0].message.content.strip().upper()
+            classification = create_chat_completion(prompt, max_tokens=10).strip().upper()
             
             # Validate response
             if classification in ["NDA", "INVOICE", "CONTRACT"]:
@@ -475,18 +2033,18 @@ Classification:"""
         else:
             return "CONTRACT"  # Default type
     
-    def split_into_chunks(self, text: str, chunk_size: int = 500, overlap: int = 100) -> List[str]:
-        """Split text into overlapping chunks."""
-        chunks = []
-        start = 0
-        text_length = len(text)
-        
-        while start < text_length:
-            end = min(start + chunk_size, text_length)
-            chunks.append(text[start:end])
-            start += chunk_size - overlap
-        
-        return chunks
+    def chunk_spans(self, text: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[Tuple[int, int]]:
+        """Character offsets [start, end) of the structure-aware chunks of text."""
+        return list(iter_chunk_spans(text, max_tokens=max_tokens))
+    
+    def split_into_chunks(self, text: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
+        """Split text into chunks along sections, paragraphs and sentences."""
+        return [text[start:end] for start, end in self.chunk_spans(text, max_tokens)]
+    
+    def identify_clause_labels(self, text: str) -> List[str]:
+        """Every clause type mentioned in text, in priority order."""
+        found = {clause_type for _, _, clause_type in detect_clause_spans(text)}
+        return [clause_type for clause_type in CLAUSE_PATTERNS if clause_type in found]
     
     def identify_clause_type(self, text: str) -> Optional[str]:
         """
@@ -495,46 +2053,103 @@ Classification:"""
         """
         # For efficiency, we'll keep the regex approach since clause identification
         # happens numerous times and making an API call for each would be expensive
-        text_lower = text.lower()
+        labels = self.identify_clause_labels(text)
+        return labels[0] if labels else None  # None: unknown clause type
+    
+    def chunk_document(self, text: str) -> Tuple[List[str], List[List[str]]]:
+        """
+        Split text into chunks and tag each with its clause labels. The
+        detector scans the whole text once; each chunk inherits the labels of
+        the clause matches that lie inside it.
+        """
+        spans = self.chunk_spans(text)
+        labels = tag_spans(spans, detect_clause_spans(text))
+        return [text[start:end] for start, end in spans], labels
+    
+    def encode_chunks(self, chunks: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        Encode chunks in batches into one (chunks x dim) float32 matrix.
+        Rows are normalized to unit length, so a dot product is cosine similarity.
+        Uses the shared embedding server when one is configured and reachable.
+        """
+        start = time.perf_counter()
+        batch_size = batch_size or EMBEDDING_BATCH_SIZE
         
-        clause_patterns = {
-            "payment_terms": r"payment\s+terms|pay\s+within|invoice\s+due|price|fee",
-            "termination": r"terminat(e|ion)|cancel|end\s+of\s+contract",
-            "liability": r"liab(le|ility)|responsible|obligation",
-            "confidentiality": r"confidential|non-disclosure|secret|proprietary",
-            "intellectual_property": r"intellectual\s+property|copyright|patent|trademark",
-            "data_protection": r"data\s+protection|privacy|personal\s+data|gdpr",
-            "warranty": r"warrant(y|ies)|guarantee",
-            "indemnification": r"indemnif(y|ication)|hold\s+harmless",
-            "force_majeure": r"force\s+majeure|act\s+of\s+god|unforeseen",
-            "non_compete": r"non-compete|competition|restraint\s+of\s+trade",
-            "governing_law": r"governing\s+law|jurisdiction|applicable\s+law"
-        }
+        client = get_embedding_client()
+        if client is not None:
+            try:
+                batches = [client.encode(chunks[i:i + batch_size]) for i in range(0, len(chunks), batch_size)]
+                embeddings = np.concatenate(batches) if batches else client.encode([])
+                elapsed = time.perf_counter() - start
+                print(f"Embedded {len(chunks)} chunks via embedding server in {elapsed:.2f}s "
+                      f"({len(chunks) / max(elapsed, 1e-9):.1f} chunks/sec)")
+                return embeddings
+            except (OSError, RuntimeError) as e:
+                # Raises unless local encoding is allowed
+                _embedding_server_failed(e)
+        
+        if not chunks:
+            return np.empty((0, get_embedding_model().get_sentence_embedding_dimension()), dtype=np.float32)
         
-        for clause_type, pattern in clause_patterns.items():
-            if re.search(pattern, text_lower):
-                return clause_type
+        embeddings = get_embedding_model().encode(
+            chunks,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        embeddings = _normalize_rows(embeddings)
+        elapsed = time.perf_counter() - start
         
-        return None  # Unknown clause type
+        print(f"Embedded {len(chunks)} chunks in {elapsed:.2f}s ({len(chunks) / max(elapsed, 1e-9):.1f} chunks/sec)")
+        return embeddings
     
-    def generate_embeddings(self, chunks: List[str]) -> List[Dict]:
-        """Generate embeddings for text chunks and identify clause types."""
+    def classify_clauses(self, embeddings: np.ndarray, clause_labels: List[List[str]]) -> List[Dict]:
+        """
+        Assign each chunk a primary clause type from its embedding, using
+        prototypes built from the labeled history. Chunks the prototypes can't
+        place confidently keep the regex result.
+        """
+        clause_types, prototypes = self.db_manager.get_clause_prototypes()
+        predicted, similarity = classify_by_prototype(embeddings, clause_types, prototypes)
+        
         result = []
+        for labels, clause_type, score in zip(clause_labels, predicted, similarity):
+            if clause_type is not None:
+                result.append({
+                    'type': clause_type,
+                    'labels': [clause_type] + [label for label in labels if label != clause_type],
+                    'type_source': 'prototype',
+                    'type_confidence': round(float(score), 4)
+                })
+            else:
+                result.append({
+                    'type': labels[0] if labels else None,
+                    'labels': labels,
+                    'type_source': 'regex' if labels else None,
+                    'type_confidence': None
+                })
+        return result
+    
+    def generate_embeddings(self, chunks: List[str], batch_size: Optional[int] = None,
+                            clause_labels: Optional[List[List[str]]] = None) -> List[Dict]:
+        """
+        Generate embeddings for text chunks and identify clause types.
+        Pass clause_labels (from chunk_document) to skip tagging each chunk again.
+        """
+        embeddings = self.encode_chunks(chunks, batch_size=batch_size)
+        if clause_labels is None:
+            clause_labels = [self.identify_clause_labels(chunk) for chunk in chunks]
         
-        for chunk in chunks:
-            # Generate embedding
-            embedding = model.encode(chunk, convert_to_tensor=True).detach().numpy()
-            
-            # Identify clause type
-            clause_type = self.identify_clause_type(chunk)
-            
-            chunk_data = {
+        # Primary type drives scoring; labels lists every clause type in the chunk
+        classified = self.classify_clauses(embeddings, clause_labels)
+        
+        result = []
+        for chunk, embedding, clause in zip(chunks, embeddings, classified):
+            result.append({
                 'text': chunk,
                 'embedding': embedding,
-                'type': clause_type
-            }
-
-            result.append(chunk_data)
+                **clause
+            })
         
         return result
     
@@ -542,56 +2157,46 @@ Classification:"""
         """Calculate risk score for a clause based on similar past clauses."""
         # If we have similar clauses, use weighted average of their risk scores
         if similar_clauses:
-            weighted_scores = []
-            total_weight = 0
-            
-            for clause in similar_clauses:
-                similarity = clause.get('similarity', 0)
-                weight = similarity  # Use similarity as weight
-                risk_score = clause.get('risk_score', 0)
-                
-                weighted_scores.append(weight * risk_score)
-                total_weight += weight
-            
-            if total_weight > 0:
-                final_score = sum(weighted_scores) / total_weight
-            else:
-                final_score = 0.5  # Default mid-level risk if no weights
+            similarities = np.array([[c.get('similarity', 0) for c in similar_clauses]], dtype=np.float32)
+            risk_scores = np.array([[c.get('risk_score', 0) for c in similar_clauses]], dtype=np.float32)
+            final_score = float(weighted_risk_scores(similarities, risk_scores)[0])
         else:
             # Default risk assessment based on clause type if no similar clauses
-            default_risks = {
-                "payment_terms": 0.6,
-                "termination": 0.7,
-                "liability": 0.8,
-                "confidentiality": 0.7,
-                "intellectual_property": 0.7,
-                "data_protection": 0.8,
-                "warranty": 0.6,
-                "indemnification": 0.7,
-                "force_majeure": 0.5,
-                "non_compete": 0.6,
-                "governing_law": 0.4
-            }
-            final_score = default_risks.get(clause_type, 0.5)
-        
-        # Determine risk level
-        if final_score >= RISK_THRESHOLDS["high"]:
-            risk_level = "high"
-        elif final_score >= RISK_THRESHOLDS["medium"]:
-            risk_level = "medium"
-        elif final_score >= RISK_THRESHOLDS["low"]:
-            risk_level = "low"
-        else:
-            risk_level = "negligible"
+            final_score = DEFAULT_CLAUSE_RISKS.get(clause_type, 0.5)
         
         return {
             "clause_type": clause_type,
             "clause_text": clause_text,
             "risk_score": final_score,
-            "risk_level": risk_level,
+            "risk_level": str(risk_levels_for_scores([final_score])[0]),
             "risk_explanation": self.generate_risk_explanation(clause_type, final_score)
         }
     
+    def calculate_risk_scores(self, clause_texts: List[str], clause_type: str, embeddings: np.ndarray) -> List[Dict]:
+        """
+        Score every chunk of one clause type in a single pass: one
+        (chunks x history) similarity product, then vectorized weighting
+        and risk-level bucketing.
+        """
+        similarities, neighbour_risks = self.db_manager.get_similar_clauses_batch(embeddings, clause_type)
+        
+        if similarities.shape[1]:
+            final_scores = weighted_risk_scores(similarities, neighbour_risks)
+        else:
+            final_scores = np.full(len(clause_texts), DEFAULT_CLAUSE_RISKS.get(clause_type, 0.5))
+        risk_levels = risk_levels_for_scores(final_scores)
+        
+        return [
+            {
+                "clause_type": clause_type,
+                "clause_text": text,
+                "risk_score": float(score),
+                "risk_level": str(level),
+                "risk_explanation": self.generate_risk_explanation(clause_type, float(score))
+            }
+            for text, score, level in zip(clause_texts, final_scores, risk_levels)
+        ]
+    
     def generate_risk_explanation(self, clause_type: str, risk_score: float) -> str:
         """
         Generate explanation for risk score using Together AI.
@@ -680,53 +2285,33 @@ Classification:"""
         else:
             return explanations[clause_type]["negligible"]
     
-    def analyze_document(self, file_path: str) -> Dict:
-        """
-        Main function to analyze a document.
-        Process: extract text -> detect type -> generate embeddings -> analyze risk
-        """
-        # Extract text from document
-        full_text = self.extract_text(file_path)
-        
-        # Detect document type
-        doc_type = self.detect_document_type(full_text)
-        
-        # Split text into chunks
-        chunks = self.split_into_chunks(full_text)
-        
-        # Generate embeddings and identify clause types
-        chunks_with_embeddings = self.generate_embeddings(chunks)
+    def _score_chunks(self, chunks_with_embeddings: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """Score typed chunks in per-type batches. Returns (risk analyses, important clauses)."""
+        # Score all chunks of each clause type together
+        typed_chunks: Dict[str, List[Dict]] = {}
+        for chunk_data in chunks_with_embeddings:
+            # Skip chunks without identified clause type
+            if chunk_data.get('type'):
+                typed_chunks.setdefault(chunk_data['type'], []).append(chunk_data)
         
-        # Insert document into database
-        document_id = self.db_manager.insert_document(
-            filename=os.path.basename(file_path),
-            doc_type=doc_type,
-            full_text=full_text,
-            metadata={"length": len(full_text), "chunks": len(chunks)}
-        )
+        for clause_type, chunk_group in typed_chunks.items():
+            scored = self.calculate_risk_scores(
+                clause_texts=[c['text'] for c in chunk_group],
+                clause_type=clause_type,
+                embeddings=np.stack([c['embedding'] for c in chunk_group])
+            )
+            for chunk_data, risk_analysis in zip(chunk_group, scored):
+                chunk_data['risk_analysis'] = risk_analysis
         
-        # Process each chunk for risk analysis
+        # Collect results in document order
         risk_analyses = []
         important_clauses = []
         
         for chunk_data in chunks_with_embeddings:
-            # Skip chunks without identified clause type
-            if not chunk_data.get('type'):
+            risk_analysis = chunk_data.pop('risk_analysis', None)
+            if risk_analysis is None:
                 continue
             
-            # Get similar clauses from database for comparison
-            similar_clauses = self.db_manager.get_similar_clauses(
-                embedding=chunk_data['embedding'],
-                clause_type=chunk_data['type']
-            )
-            
-            # Calculate risk score
-            risk_analysis = self.calculate_risk_score(
-                clause_text=chunk_data['text'],
-                clause_type=chunk_data['type'],
-                similar_clauses=similar_clauses
-            )
-            
             # Add risk score to chunk data
             chunk_data['risk_score'] = risk_analysis['risk_score']
             
@@ -734,6 +2319,7 @@ Classification:"""
             if chunk_data['type'] in IMPORTANT_CLAUSES or risk_analysis['risk_score'] >= RISK_THRESHOLDS["medium"]:
                 important_clauses.append({
                     'type': chunk_data['type'],
+                    'labels': chunk_data.get('labels', [chunk_data['type']]),
                     'text': chunk_data['text'],
                     'risk_score': risk_analysis['risk_score'],
                     'risk_level': risk_analysis['risk_level'],
@@ -742,55 +2328,173 @@ Classification:"""
             
             risk_analyses.append(risk_analysis)
         
-        # Insert embeddings and risk analysis into database
-        self.db_manager.insert_embeddings(document_id, chunks_with_embeddings)
-        self.db_manager.insert_risk_analysis(document_id, risk_analyses)
+        return risk_analyses, important_clauses
+    
+    def analyze_document(self, file_path: str, user_id: Optional[int] = None, filename: Optional[str] = None,
+                         content_hash: Optional[str] = None,
+                         on_saved: Optional[Callable[[int], None]] = None) -> Dict:
+        """
+        Main function to analyze a document.
+        Process: extract text -> detect type -> generate embeddings -> analyze risk
+        
+        Stages run concurrently as soon as their inputs are ready: document
+        type detection overlaps chunking, embedding and scoring, and summary
+        generation overlaps the database writes.
+        
+        on_saved is called with the new document id inside the transaction
+        that saves the document, so whatever it writes commits with it.
+        """
+        filename = filename or os.path.basename(file_path)
+        
+        def save(pages, full_text, doc_type, embedded_chunks, scores):
+            risk_analyses, _ = scores
+            with self.db_manager.connection():
+                document_id = self.db_manager.save_document_analysis(
+                    filename=filename,
+                    doc_type=doc_type,
+                    full_text=full_text,
+                    metadata={
+                        "length": len(full_text),
+                        "chunks": len(embedded_chunks),
+                        "pages": len(pages),
+                        "page_offsets": page_offsets(pages)
+                    },
+                    chunks_with_embeddings=embedded_chunks,
+                    risk_analyses=risk_analyses,
+                    user_id=user_id,
+                    content_hash=content_hash or file_sha256(file_path),
+                    storage_path=file_path
+                )
+                if on_saved:
+                    on_saved(document_id)
+            # Only now is the document committed, so its chunks can't be rolled back
+            self.db_manager.refresh_clause_index()
+            return document_id
+        
+        stages = {
+            # Extract text from document, keeping page boundaries. Chunking needs the
+            # whole text (sections span pages), so the pages are collected first.
+            'pages': (lambda: self.extract_pages(file_path), []),
+            'full_text': (lambda pages: PAGE_SEPARATOR.join(pages), ['pages']),
+            'doc_type': (lambda full_text: self.detect_document_type(full_text), ['full_text']),
+            # Split text into chunks tagged with clause types, then generate embeddings
+            'chunks': (lambda full_text: self.chunk_document(full_text), ['full_text']),
+            'embedded_chunks': (lambda chunks: self.generate_embeddings(chunks[0], clause_labels=chunks[1]), ['chunks']),
+            'scores': (lambda embedded_chunks: self._score_chunks(embedded_chunks), ['embedded_chunks']),
+            # Insert document, embeddings and risk analysis in one transaction
+            'document_id': (save, ['pages', 'full_text', 'doc_type', 'embedded_chunks', 'scores']),
+            # Generate AI-based document summary
+            'summary': (
+                lambda full_text, doc_type, scores: self.generate_document_summary(full_text, doc_type, scores[1]),
+                ['full_text', 'doc_type', 'scores']
+            )
+        }
+        
+        start = time.perf_counter()
+        results, timings = run_stage_graph(stages)
+        total = time.perf_counter() - start
         
-        # Generate AI-based document summary
-        brief_summary = self.generate_document_summary(full_text, doc_type, important_clauses)
+        print("Stage timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()) + f" (total {total:.2f}s)")
         
-        summary = {
+        risk_analyses, important_clauses = results['scores']
+        document_id = results['document_id']
+        
+        analysis = {
             'document_id': document_id,
-            'filename': os.path.basename(file_path),
-            'document_type': doc_type,
-            'summary': brief_summary,
+            'filename': filename,
+            'document_type': results['doc_type'],
+            'summary': results['summary'],
             'important_clauses': important_clauses,
+            'clauses': [
+                {
+                    'type': a['clause_type'],
+                    'text': a['clause_text'],
+                    'risk_score': a['risk_score'],
+                    'risk_level': a['risk_level'],
+                    'explanation': a['risk_explanation']
+                }
+                for a in risk_analyses
+            ],
             'overall_risk_score': sum(a['risk_score'] for a in risk_analyses) / len(risk_analyses) if risk_analyses else 0,
+            'metadata': {'chunks': len(results['embedded_chunks']), 'pages': len(results['pages'])},
             'analysis_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         
+        # Persist the complete result so document views don't recompute it
+        if document_id:
+            self.db_manager.save_analysis_snapshot(document_id, analysis)
+        
+        summary = {key: value for key, value in analysis.items() if key not in ('clauses', 'metadata')}
+        summary['stage_timings'] = {name: round(seconds, 3) for name, seconds in timings.items()}
+        
         return summary
     
-    def query_document(self, query: str, document_id: Optional[int] = None) -> Dict:
+    def load_document_chunks(self, document_id: int) -> Optional[DocumentChunks]:
         """
-        Query function that uses Together AI to answer questions about the document.
+        A document's chunks and vectors for question answering, from the cache
+        when an earlier question already loaded them.
         """
-        # Get document text
-        document_text = ""
-        document_info = {}
+        cached = self.db_manager.document_chunks.get(document_id)
+        if cached is not None:
+            return cached
         
-        if document_id:
-            with self.db_manager.conn.cursor() as cursor:
-                cursor.execute(
-                    "SELECT full_text, filename, doc_type FROM documents WHERE id = %s", 
-                    (document_id,)
-                )
-                result = cursor.fetchone()
-                if result:
-                    document_text, filename, doc_type = result
-                    document_info = {'filename': filename, 'doc_type': doc_type}
-        else:
+        loaded = self.db_manager.get_document_chunks(document_id)
+        if loaded is None:
+            return None
+        
+        texts, vectors = loaded['texts'], loaded['vectors']
+        if loaded['full_text'] is not None:
+            # Analyzed before every chunk was stored: chunk and embed it now (kept in the cache only)
+            texts = self.split_into_chunks(loaded['full_text'])
+            vectors = self.encode_chunks(texts)
+        
+        chunks = DocumentChunks(document_id, loaded['info'], texts, vectors)
+        self.db_manager.document_chunks.put(document_id, chunks)
+        return chunks
+    
+    def retrieve_context(self, query: str, chunks: DocumentChunks, top_k: int = QUERY_TOP_K,
+                         max_tokens: int = QUERY_CONTEXT_TOKENS) -> str:
+        """
+        Rank the document's chunks against the question and join the best ones,
+        within the token budget, in document order.
+        """
+        if not chunks.texts:
+            return ""
+        
+        query_vector = self.encode_chunks([query])
+        scores = chunks.rank(query_vector, query_terms(query))
+        
+        selected = []
+        used = 0
+        for i in np.argsort(-scores)[:top_k]:
+            if used + chunks.token_counts[i] > max_tokens:
+                continue
+            selected.append(i)
+            used += chunks.token_counts[i]
+        
+        return "\n\n".join(chunks.texts[i] for i in sorted(selected))
+    
+    def _resolve_query_document(self, document_id: Optional[int]) -> Optional[DocumentChunks]:
+        """The chunks of the given document, or of the most recent one when no id is given."""
+        if not document_id:
             # If no specific document_id, get the most recent document
-            with self.db_manager.conn.cursor() as cursor:
-                cursor.execute(
-                    "SELECT id, full_text, filename, doc_type FROM documents ORDER BY upload_date DESC LIMIT 1"
-                )
+            with self.db_manager.connection() as conn, conn.cursor() as cursor:
+                cursor.execute("SELECT id FROM documents ORDER BY upload_date DESC LIMIT 1")
                 result = cursor.fetchone()
-                if result:
-                    document_id, document_text, filename, doc_type = result
-                    document_info = {'filename': filename, 'doc_type': doc_type}
+                document_id = result[0] if result else None
+        
+        chunks = self.load_document_chunks(document_id) if document_id else None
+        if chunks is None or not chunks.texts:
+            return None
+        return chunks
+    
+    def query_document(self, query: str, document_id: Optional[int] = None, user_id: Optional[int] = None) -> Dict:
+        """
+        Query function that uses Together AI to answer questions about the document.
+        """
+        chunks = self._resolve_query_document(document_id)
         
-        if not document_text:
+        if chunks is None:
             return {
                 'query': query,
                 'answer': "No document found to query.",
@@ -798,51 +2502,68 @@ Classification:"""
                 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
         
-        # Get answer using Together AI
-        answer = self.generate_together_answer(query, document_text)
+        # Get answer using Together AI over the most relevant chunks
+        answer = self.generate_together_answer(query, self.retrieve_context(query, chunks))
+        self.db_manager.record_query(chunks.document_id, user_id, query, answer)
         
         return {
             'query': query,
             'answer': answer,
-            'document_info': document_info,
+            'document_info': chunks.info,
             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
     
-    def generate_together_answer(self, query: str, document_text: str) -> str:
+    def stream_query_document(self, query: str, document_id: Optional[int] = None,
+                              user_id: Optional[int] = None) -> Iterator[Dict]:
         """
-        Generate an answer to the query using Together AI's LLM.
+        Streaming variant of query_document. Yields a 'document' event with
+        the document info, a 'token' event per piece of the answer as Together
+        AI generates it, then a 'done' event with the full answer, which is
+        recorded once the stream completes. Closing the generator stops the
+        upstream request.
         """
+        chunks = self._resolve_query_document(document_id)
+        
+        if chunks is None:
+            yield {'event': 'error', 'message': "No document found to query."}
+            return
+        
+        yield {'event': 'document', 'document_info': chunks.info}
+        
+        context = self.retrieve_context(query, chunks)
+        parts = []
+        # Held so that closing this generator (the client went away) cancels the
+        # upstream completion right away instead of whenever it is collected
+        tokens = stream_chat_completion(self._answer_prompt(query, context), max_tokens=1000, temperature=0.2)
         try:
-            # Find potential relevant sections to reduce context size
-            query_terms = query.lower().split()
-            paragraphs = document_text.split('\n\n')
-            
-            # Score paragraphs by relevance
-            scored_paragraphs = []
-            for para in paragraphs:
-                if len(para.strip()) < 10:  # Skip very short paragraphs
-                    continue
-                    
-                # Simple relevance scoring
-                score = sum(1 for term in query_terms if term in para.lower())
-                scored_paragraphs.append((score, para))
-            
-            # Sort by relevance score
-            scored_paragraphs.sort(reverse=True)
-            
-            # Take top relevant paragraphs that fit within context limits
-            context = ""
-            for _, para in scored_paragraphs[:7]:  # Limit to top 7 paragraphs
-                if len(context) + len(para) < 4000:  # Keep context size manageable
-                    context += para + "\n\n"
-            
-            # If we found no relevant context, use the beginning of the document
-            if not context:
-                context = document_text[:4000]
-            # print(context)
-            # print(query)
-            # Prepare prompt for Together AI
-            prompt = f"""I need you to answer a question about a document. document text is given ahead. give good answers(longer when required)"
+            for token in tokens:
+                parts.append(token)
+                yield {'event': 'token', 'text': token}
+        except Exception as e:
+            print(f"Together AI error: {str(e)}")
+            if parts:
+                yield {'event': 'error', 'message': "The answer was interrupted. Please try again."}
+                return
+            # Nothing streamed yet: fall back to keyword matching, as query_document does
+            parts = [self._keyword_answer(query, context)]
+            yield {'event': 'token', 'text': parts[0]}
+        finally:
+            tokens.close()
+        
+        answer = "".join(parts).strip()
+        self.db_manager.record_query(chunks.document_id, user_id, query, answer, streamed=True)
+        
+        yield {
+            'event': 'done',
+            'query': query,
+            'answer': answer,
+            'document_info': chunks.info,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+    
+    def _answer_prompt(self, query: str, context: str) -> str:
+        """Prompt asking Together AI to answer a question from the retrieved context."""
+        return f"""I need you to answer a question about a document. document text is given ahead. give good answers(longer when required)"
 
 question: {query}
 
@@ -850,34 +2571,37 @@ Document text:
 {context}
 
 Answer: start point wise"""
-            
-            # Call Together AI
-            response = together_client.chat.completions.create(
-                model=TOGETHER_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.2  # Lower temperature for more factual responses
-            )
-            
-            answer = response.choices[0].message.content.strip()
+    
+    def _keyword_answer(self, query: str, context: str) -> str:
+        """Very basic answer from lines matching the query's words, for when the LLM fails."""
+        query_lower = query.lower()
+        lines = context.split('\n')
+        
+        relevant_lines = []
+        for line in lines:
+            if any(term in line.lower() for term in query_lower.split()):
+                relevant_lines.append(line)
+        
+        if relevant_lines:
+            return f"I found these relevant sections in the document:\n\n" + "\n".join(relevant_lines[:5])
+        else:
+            return "I couldn't find specific information related to your query in the document."
+    
+    def generate_together_answer(self, query: str, context: str) -> str:
+        """
+        Generate an answer to the query using Together AI's LLM, from the
+        retrieved document context.
+        """
+        try:
+            # Call Together AI (lower temperature for more factual responses)
+            answer = create_chat_completion(self._answer_prompt(query, context), max_tokens=1000, temperature=0.2).strip()
             return answer
                 
         except Exception as e:
             print(f"Together AI error: {str(e)}")
             
             # Very basic fallback with keyword matching if AI fails
-            query_lower = query.lower()
-            lines = document_text.split('\n')
-            
-            relevant_lines = []
-            for line in lines:
-                if any(term in line.lower() for term in query_lower.split()):
-                    relevant_lines.append(line)
-            
-            if relevant_lines:
-                return f"I found these relevant sections in the document:\n\n" + "\n".join(relevant_lines[:5])
-            else:
-                return "I couldn't find specific information related to your query in the document."
+            return self._keyword_answer(query, context)
 
 
 def print_analysis_summary(analysis: Dict):
@@ -932,19 +2656,24 @@ def interactive_query_mode(analyzer: ContractAnalyzer, document_id: Optional[int
         
         print("\nProcessing query using Llama 3.3 70B model...")
         
-        # Process query with Together AI
-        response = analyzer.query_document(query, document_id)
-        
-        # Print answer from LLM
-        print("\nANSWER:")
-        print("-"*80)
-        print(response['answer'])
+        # Process query with Together AI, printing the answer as it is generated
+        document_info = {}
+        for event in analyzer.stream_query_document(query, document_id):
+            if event['event'] == 'document':
+                document_info = event['document_info']
+                print("\nANSWER:")
+                print("-"*80)
+            elif event['event'] == 'token':
+                print(event['text'], end='', flush=True)
+            elif event['event'] == 'error':
+                print(f"\n{event['message']}")
+        print()
         print("-"*80)
         
         # Print document information
-        if response['document_info']:
-            print(f"Source: {response['document_info'].get('filename', 'Unknown document')} "
-                  f"({response['document_info'].get('doc_type', 'Unknown type')})")
+        if document_info:
+            print(f"Source: {document_info.get('filename', 'Unknown document')} "
+                  f"({document_info.get('doc_type', 'Unknown type')})")
             print("-"*80)
 
 
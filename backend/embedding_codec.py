@@ -0,0 +1,74 @@
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# How new embeddings are stored: float32 (exact), float16 or int8 (scalar
+# quantized with a per-vector scale). Rows in any format can be read back.
+EMBEDDING_STORAGE_FORMAT = os.getenv("EMBEDDING_STORAGE_FORMAT", "float32")
+
+# Stored in embeddings.embedding_format
+FORMAT_CODES = {"float32": 0, "float16": 1, "int8": 2}
+FORMAT_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2"), 2: np.dtype("i1")}
+
+
+def encode_embedding(vector: np.ndarray, fmt: str = EMBEDDING_STORAGE_FORMAT) -> Tuple[bytes, int, Optional[float]]:
+    """Pack one vector as (bytes, format code, scale). Scale is None except for int8."""
+    code = FORMAT_CODES[fmt]
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    if fmt != "int8":
+        return vector.astype(FORMAT_DTYPES[code]).tobytes(), code, None
+
+    # Symmetric quantization: the largest component maps to +/-127
+    peak = float(np.abs(vector).max()) if vector.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+    return quantized.tobytes(), code, scale
+
+
+def decode_embedding(blob, code: int, scale: Optional[float] = None) -> np.ndarray:
+    """
+    Unpack one stored vector. float32 blobs come back as a read-only view
+    of the buffer (no copy); other formats are widened to float32.
+    """
+    values = np.frombuffer(blob, dtype=FORMAT_DTYPES[code])
+    if code == FORMAT_CODES["float32"]:
+        return values
+    values = values.astype(np.float32)
+    if scale is not None:
+        values *= scale
+    return values
+
+
+def decode_embeddings(blobs: Sequence, codes: Sequence[int], scales: Sequence[Optional[float]]) -> np.ndarray:
+    """Unpack stored vectors of equal dimension into one float32 matrix, one row each."""
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+
+    code = codes[0]
+    if all(other == code for other in codes):
+        # One join and a view over it, instead of a parse per row
+        matrix = np.frombuffer(b"".join(blobs), dtype=FORMAT_DTYPES[code]).reshape(len(blobs), -1)
+        if code == FORMAT_CODES["float32"]:
+            return matrix
+        matrix = matrix.astype(np.float32)
+        if code == FORMAT_CODES["int8"]:
+            matrix *= np.asarray([1.0 if scale is None else scale for scale in scales], dtype=np.float32)[:, None]
+        return matrix
+
+    rows = [decode_embedding(blob, code, scale) for blob, code, scale in zip(blobs, codes, scales)]
+    return np.stack(rows).astype(np.float32, copy=False)
+
+
+def stored_vectors(rows: List[tuple]) -> np.ndarray:
+    """
+    Matrix of vectors from (embedding_blob, embedding_format, embedding_scale,
+    embedding_vector) column values. Rows not yet converted to the compact
+    format are read from the float array column.
+    """
+    if all(row[0] is not None for row in rows):
+        return decode_embeddings([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+    return np.stack([
+        decode_embedding(blob, code, scale) if blob is not None else np.asarray(vector, dtype=np.float32)
+        for blob, code, scale, vector in rows
+    ]).astype(np.float32, copy=False)
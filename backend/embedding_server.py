@@ -0,0 +1,209 @@
+import os
+import json
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Embedding server settings
+EMBEDDING_SERVER_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET", "")  # empty: every process loads its own model
+EMBEDDING_SERVER_MAX_BATCH = int(os.getenv("EMBEDDING_SERVER_MAX_BATCH", "64"))
+EMBEDDING_SERVER_MAX_WAIT_MS = float(os.getenv("EMBEDDING_SERVER_MAX_WAIT_MS", "5"))
+EMBEDDING_SERVER_TIMEOUT = float(os.getenv("EMBEDDING_SERVER_TIMEOUT", "60"))
+
+# Every message is a 4-byte big-endian length followed by that many bytes.
+# Requests carry JSON {"texts": [...]}; responses carry a JSON header
+# {"rows": n, "dim": d} (or {"error": "..."}) followed by n*d float32 values.
+_LENGTH = struct.Struct("!I")
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytearray:
+    """Read exactly size bytes from a socket (into a writable buffer)."""
+    buf = bytearray()
+    while len(buf) < size:
+        part = sock.recv(size - len(buf))
+        if not part:
+            raise ConnectionError("Embedding server connection closed")
+        buf.extend(part)
+    return buf
+
+
+def _send_message(sock: socket.socket, payload: bytes) -> None:
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def _recv_message(sock: socket.socket) -> bytes:
+    (size,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return _recv_exact(sock, size)
+
+
+class EmbeddingClient:
+    """Client for a local embedding server. encode() returns normalized float32 rows."""
+
+    def __init__(self, socket_path: str = EMBEDDING_SERVER_SOCKET, timeout: float = EMBEDDING_SERVER_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts on the server. Raises OSError if the server is unreachable."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            _send_message(sock, json.dumps({"texts": texts}).encode("utf-8"))
+            header = json.loads(_recv_message(sock))
+            if "error" in header:
+                raise RuntimeError(f"Embedding server error: {header['error']}")
+            rows, dim = header["rows"], header["dim"]
+            data = _recv_exact(sock, rows * dim * 4)
+        return np.frombuffer(data, dtype=np.float32).reshape(rows, dim)
+
+
+class MicroBatcher:
+    """
+    Collects encode requests from many connections into one model call.
+    A batch is flushed once it holds max_batch texts or the first request in
+    it has waited max_wait_ms, whichever comes first.
+    """
+
+    def __init__(self, model, max_batch: int = EMBEDDING_SERVER_MAX_BATCH,
+                 max_wait_ms: float = EMBEDDING_SERVER_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._requests: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        self._stats = {"requests": 0, "batches": 0, "texts": 0}
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for the next batch; the future resolves to their embeddings."""
+        future = Future()
+        self._requests.put((texts, future))
+        return future
+
+    def _collect(self) -> List[Tuple[List[str], Future]]:
+        """Block for one request, then gather more until the batch is full or the wait expires."""
+        batch = [self._requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=self.max_batch,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                ).astype(np.float32, copy=False)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for request_texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+            self._stats["requests"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["texts"] += len(texts)
+
+    def stats(self) -> Dict[str, float]:
+        stats = dict(self._stats)
+        stats["texts_per_batch"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+class _EncodeHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(_recv_message(self.request))
+            texts = request["texts"]
+            if texts:
+                embeddings = self.server.batcher.submit(texts).result()
+            else:
+                embeddings = np.empty((0, self.server.dim), dtype=np.float32)
+        except ConnectionError:
+            return
+        except Exception as e:
+            _send_message(self.request, json.dumps({"error": str(e)}).encode("utf-8"))
+            return
+
+        rows, dim = embeddings.shape
+        _send_message(self.request, json.dumps({"rows": rows, "dim": dim}).encode("utf-8"))
+        self.request.sendall(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    """Unix-socket server that owns the embedding model for every worker on the host."""
+
+    daemon_threads = True
+    # Every worker thread on the host may connect at once
+    request_queue_size = 128
+
+    def __init__(self, socket_path: str, model, max_batch: int = EMBEDDING_SERVER_MAX_BATCH,
+                 max_wait_ms: float = EMBEDDING_SERVER_MAX_WAIT_MS):
+        # A socket file left behind by a previous run would make bind() fail
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.dim = model.get_sentence_embedding_dimension()
+        self.batcher = MicroBatcher(model, max_batch=max_batch, max_wait_ms=max_wait_ms)
+        super().__init__(socket_path, _EncodeHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared embedding server for contract analyzer workers')
+    parser.add_argument('--socket', default=EMBEDDING_SERVER_SOCKET or '/tmp/contract_embeddings.sock',
+                        help='Unix socket path to listen on')
+    parser.add_argument('--max-batch', type=int, default=EMBEDDING_SERVER_MAX_BATCH,
+                        help='Maximum texts encoded in one model call')
+    parser.add_argument('--max-wait-ms', type=float, default=EMBEDDING_SERVER_MAX_WAIT_MS,
+                        help='How long a request may wait for others to join its batch')
+    args = parser.parse_args()
+
+    # get_embedding_model always loads the model in this process, even if EMBEDDING_SERVER_SOCKET is set
+    from contract_analyzer import get_embedding_model
+
+    model = get_embedding_model()
+    server = EmbeddingServer(args.socket, model, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    print(f"Embedding server listening on {args.socket} (max batch {args.max_batch}, max wait {args.max_wait_ms}ms)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Embedding server stats: {server.batcher.stats()}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import io
+import os
+import csv
+import sys
+import json
+import argparse
+from typing import Iterable, Iterator, List, Optional
+
+from contract_analyzer import DatabaseManager, risk_levels_for_scores
+
+# Rows fetched from the server-side cursor per round trip
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+EXPORT_COLUMNS = [
+    'document_id', 'filename', 'document_type', 'upload_date', 'clause_type',
+    'clause_text', 'risk_score', 'risk_level', 'risk_explanation', 'analysis_date'
+]
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _format_batch(rows: List[tuple]) -> Iterator[List]:
+    """Yield export records (in EXPORT_COLUMNS order) for one batch of clause rows."""
+    risk_levels = risk_levels_for_scores([row[6] for row in rows])
+    for (document_id, filename, doc_type, upload_date, clause_type, clause_text,
+         risk_score, risk_explanation, analysis_date), risk_level in zip(rows, risk_levels):
+        yield [
+            document_id,
+            filename,
+            doc_type,
+            upload_date.strftime('%Y-%m-%d %H:%M:%S') if upload_date else None,
+            clause_type,
+            clause_text,
+            risk_score,
+            str(risk_level),
+            risk_explanation,
+            analysis_date.strftime('%Y-%m-%d %H:%M:%S') if analysis_date else None
+        ]
+
+
+def iter_ndjson(batches: Iterable[List[tuple]]) -> Iterator[str]:
+    """One JSON object per clause, one string per batch."""
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, record))) + "\n" for record in _format_batch(rows))
+
+
+def iter_csv(batches: Iterable[List[tuple]]) -> Iterator[str]:
+    """A header line, then one CSV row per clause, one string per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_format_batch(rows))
+        yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv
+}
+
+
+def export_analyses(db_manager: DatabaseManager, fmt: str, user_id: Optional[int] = None,
+                    document_ids: Optional[List[int]] = None, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """Stream the scored clauses of one or many analyses as NDJSON or CSV text."""
+    batches = db_manager.iter_clause_export(user_id, document_ids, batch_size=batch_size)
+    return EXPORT_FORMATS[fmt](batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export analyzed clauses as NDJSON or CSV')
+    parser.add_argument('--format', '-f', choices=sorted(EXPORT_FORMATS), default='ndjson', help='Output format')
+    parser.add_argument('--user-id', '-u', type=int, help='Only export this user\'s documents (default: all users)')
+    parser.add_argument('--document-id', '-d', type=int, action='append', dest='document_ids',
+                        help='Only export this document (repeatable)')
+    parser.add_argument('--output', '-o', help='Output file (default: stdout)')
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for part in export_analyses(db_manager, args.format, args.user_id, args.document_ids):
+            out.write(part)
+    finally:
+        if args.output:
+            out.close()
+        db_manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Production entrypoint: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# Analyses run on background threads; requests themselves stay short
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def post_fork(server, worker):
+    # Models, the connection pool and the analysis workers belong to each worker
+    # process, so they start after the fork rather than in the master
+    import app
+    app.warm_up()
+
+
+def worker_exit(server, worker):
+    import app
+    app.job_queue.stop(timeout=5)
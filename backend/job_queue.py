@@ -0,0 +1,301 @@
+import os
+import json
+import threading
+import traceback
+from typing import Callable, Dict, List, Optional
+
+import psycopg2
+
+from contract_analyzer import DatabaseManager, PoolTimeoutError
+
+# Background analysis settings
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "5"))
+# A running job whose lease expires (worker crashed or was killed) is picked up again.
+# The worker running a job renews its lease every JOB_HEARTBEAT_INTERVAL seconds.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", str(JOB_LEASE_SECONDS / 4)))
+
+# Failures worth retrying: the database or a network dependency was briefly unavailable
+TRANSIENT_ERRORS = (
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    PoolTimeoutError,
+    ConnectionError,
+    TimeoutError
+)
+
+JOB_COLUMNS = "id, user_id, file_path, filename, status, attempts, max_attempts, document_id, result, error, created_at, updated_at"
+
+
+class AnalysisJobQueue:
+    """
+    Durable queue of document analysis jobs stored in Postgres.
+    A pool of worker threads claims jobs with FOR UPDATE SKIP LOCKED, so any
+    number of processes can share the same queue table safely.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, handler: Callable[[Dict], Dict],
+                 workers: int = ANALYSIS_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.db_manager = db_manager
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, user_id: Optional[int], file_path: str, filename: str,
+                content_hash: Optional[str] = None) -> int:
+        """
+        Persist a new queued job and return its id. If the user already has a
+        queued or running job for the same content_hash, that job's id is
+        returned instead.
+        """
+        # Workers come up on first use unless warm-up already started them
+        self.start()
+        
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            # A concurrent insert for the same upload makes this one a no-op
+            cursor.execute(
+                """
+                INSERT INTO analysis_jobs
+                (user_id, file_path, filename, content_hash, status, max_attempts, created_at, updated_at, run_after)
+                VALUES (%s, %s, %s, %s, 'queued', %s, NOW(), NOW(), NOW())
+                ON CONFLICT (user_id, content_hash) WHERE status IN ('queued', 'running') DO NOTHING
+                RETURNING id
+                """,
+                (user_id, file_path, filename, content_hash, self.max_attempts)
+            )
+            row = cursor.fetchone()
+            job_id = row[0] if row else self.find_active_job(user_id, content_hash)
+
+        self.wake()
+        return job_id
+
+    def find_active_job(self, user_id: Optional[int], content_hash: str) -> Optional[int]:
+        """The user's queued or running job for an upload with this content hash, if any."""
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id FROM analysis_jobs
+                WHERE user_id IS NOT DISTINCT FROM %s AND content_hash = %s
+                  AND status IN ('queued', 'running')
+                """,
+                (user_id, content_hash)
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def wake(self) -> None:
+        """
+        Let an idle local worker look for work without waiting for the next
+        poll. Call again once an outer transaction that enqueued has committed.
+        """
+        self._wakeup.set()
+
+    def get_job(self, job_id: int, user_id: Optional[int] = None) -> Optional[Dict]:
+        """Return a job's status (and result once finished), scoped to a user if given."""
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            if user_id is None:
+                cursor.execute(f"SELECT {JOB_COLUMNS} FROM analysis_jobs WHERE id = %s", (job_id,))
+            else:
+                cursor.execute(
+                    f"SELECT {JOB_COLUMNS} FROM analysis_jobs WHERE id = %s AND user_id = %s",
+                    (job_id, user_id)
+                )
+            row = cursor.fetchone()
+
+        if not row:
+            return None
+
+        (job_id, user_id, _, filename, status, attempts, max_attempts,
+         document_id, result, error, created_at, updated_at) = row
+        return {
+            'job_id': job_id,
+            'filename': filename,
+            'status': status,
+            'attempts': attempts,
+            'max_attempts': max_attempts,
+            'document_id': document_id,
+            'result': result,
+            'error': error,
+            'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    def record_document(self, job_id: int, document_id: int) -> None:
+        """
+        Note the document a job's run saved. Call inside the transaction that
+        saves it, so a retry finds the document instead of analyzing again.
+        """
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE analysis_jobs SET document_id = %s, updated_at = NOW() WHERE id = %s",
+                (document_id, job_id)
+            )
+
+    def _claim(self) -> Optional[Dict]:
+        """Atomically mark the next runnable job as running and return it."""
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'running',
+                    attempts = attempts + 1,
+                    locked_until = NOW() + make_interval(secs => %s),
+                    updated_at = NOW()
+                WHERE id = (
+                    SELECT id FROM analysis_jobs
+                    WHERE (status = 'queued' AND run_after <= NOW())
+                       OR (status = 'running' AND locked_until < NOW())
+                    ORDER BY run_after, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id, file_path, filename, content_hash, attempts, max_attempts, document_id
+                """,
+                (JOB_LEASE_SECONDS,)
+            )
+            row = cursor.fetchone()
+
+        if not row:
+            return None
+
+        job_id, user_id, file_path, filename, content_hash, attempts, max_attempts, document_id = row
+        return {
+            'id': job_id,
+            'user_id': user_id,
+            'file_path': file_path,
+            'filename': filename,
+            'content_hash': content_hash,
+            'attempts': attempts,
+            'max_attempts': max_attempts,
+            # Set when an earlier attempt already saved the document
+            'document_id': document_id
+        }
+
+    def _renew_lease(self, job: Dict) -> bool:
+        """Push a running job's lease forward. False if the job is no longer this run's."""
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET locked_until = NOW() + make_interval(secs => %s)
+                WHERE id = %s AND status = 'running' AND attempts = %s
+                """,
+                (JOB_LEASE_SECONDS, job['id'], job['attempts'])
+            )
+            return cursor.rowcount == 1
+
+    def _heartbeat(self, job: Dict, done: threading.Event) -> None:
+        """Renew the job's lease until done is set."""
+        while not done.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                if not self._renew_lease(job):
+                    print(f"Analysis job {job['id']} lease was taken over by another worker")
+                    return
+            except Exception as e:
+                # Keep trying; the lease only lapses if renewals fail for its whole length
+                print(f"Could not renew lease of analysis job {job['id']}: {str(e)}")
+
+    def _complete(self, job_id: int, result: Dict) -> None:
+        """Record a successful run."""
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'succeeded', result = %s, document_id = %s, error = NULL,
+                    locked_until = NULL, updated_at = NOW()
+                WHERE id = %s
+                """,
+                (json.dumps(result), result.get('document_id'), job_id)
+            )
+
+    def _fail(self, job: Dict, error: Exception) -> None:
+        """Schedule a retry with exponential backoff, or mark the job failed."""
+        retry = isinstance(error, TRANSIENT_ERRORS) and job['attempts'] < job['max_attempts']
+        delay = JOB_RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1))
+
+        with self.db_manager.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = %s, error = %s, locked_until = NULL, updated_at = NOW(),
+                    run_after = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+                """,
+                ('queued' if retry else 'failed', str(error), delay if retry else 0, job['id'])
+            )
+
+        action = f"retrying in {delay:.0f}s" if retry else "giving up"
+        print(f"Analysis job {job['id']} attempt {job['attempts']} failed: {str(error)} ({action})")
+
+    def _run(self, job: Dict) -> None:
+        """Run one claimed job through the handler."""
+        if job['attempts'] > job['max_attempts']:
+            # Lease expired after the last allowed attempt, e.g. the worker was killed mid-run
+            self._fail(job, RuntimeError("Job exceeded its attempt limit"))
+            return
+
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job, done), name=f"analysis-lease-{job['id']}", daemon=True
+        )
+        heartbeat.start()
+        try:
+            result = self.handler(job)
+        except Exception as e:
+            traceback.print_exc()
+            self._fail(job, e)
+            return
+        finally:
+            done.set()
+
+        self._complete(job['id'], result)
+
+    def _worker_loop(self) -> None:
+        """Claim and run jobs until stopped."""
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Analysis worker could not claim a job: {str(e)}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._run(job)
+            except Exception as e:
+                # Recording the outcome failed; the lease will expire and the job is retried
+                print(f"Analysis worker lost track of job {job['id']}: {str(e)}")
+
+    def start(self) -> None:
+        """Start the background worker threads (the jobs table comes from migrations.py)."""
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"analysis-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        print(f"Started {self.workers} analysis workers")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Signal workers to stop after their current job and wait for them."""
+        self._stop.set()
+        self._wakeup.set()
+        with self._start_lock:
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
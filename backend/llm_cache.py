@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+# Cache settings
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")  # empty disables the durable tier
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "1024"))
+LLM_CACHE_DISK_ENTRIES = int(os.getenv("LLM_CACHE_DISK_ENTRIES", "50000"))
+
+# How many disk writes happen between eviction sweeps
+EVICTION_INTERVAL = 100
+
+
+class LLMCache:
+    """
+    Two-tier cache for LLM completions: an in-memory LRU in front of a
+    SQLite table shared by every process on the host. Entries expire after a
+    TTL and each tier is capped by entry count. Concurrent requests for the
+    same key wait on a single in-flight call instead of each calling the API.
+    The SQLite tier is best effort: if it fails (e.g. stays locked under load),
+    lookups miss and writes are dropped rather than failing the caller.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL,
+                 memory_entries: int = LLM_CACHE_MEMORY_ENTRIES, disk_entries: int = LLM_CACHE_DISK_ENTRIES):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "disk_errors": 0
+        }
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access_idx ON llm_cache (last_access)")
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], **params) -> str:
+        """Stable key over the model, prompt messages and sampling parameters."""
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return value
+
+    def _memory_put(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_error(self, action: str, error: sqlite3.Error) -> None:
+        with self._lock:
+            self._stats["disk_errors"] += 1
+        print(f"LLM cache could not {action} the disk tier: {str(error)}")
+
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        if self._db is None:
+            return None
+        now = time.time()
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at >= ?",
+                    (key, now)
+                ).fetchone()
+                if row:
+                    self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            self._disk_error("read", e)
+            return None
+        return row
+
+    def _disk_put(self, key: str, value: str, expires_at: float) -> None:
+        if self._db is None:
+            return
+        now = time.time()
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now)
+                )
+                self._writes += 1
+                if self._writes % EVICTION_INTERVAL == 0:
+                    self._evict(now)
+        except sqlite3.Error as e:
+            self._disk_error("write", e)
+
+    def _evict(self, now: float) -> None:
+        """Drop expired entries, then the least recently used beyond the size cap."""
+        self._db.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        self._db.execute(
+            """
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.disk_entries,)
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value for key, or None, without computing anything."""
+        value = self._memory_get(key)
+        if value is not None:
+            with self._lock:
+                self._stats["memory_hits"] += 1
+            return value
+
+        row = self._disk_get(key)
+        if row:
+            value, expires_at = row
+            self._memory_put(key, value, expires_at)
+            with self._lock:
+                self._stats["disk_hits"] += 1
+            return value
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        """Store a value computed elsewhere, e.g. a completed streamed answer. Empty values aren't cached."""
+        if not value:
+            return
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, value, expires_at)
+        self._disk_put(key, value, expires_at)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        """
+        Return the cached value for key, computing and storing it on a miss.
+        An empty or None result is returned but not cached.
+        """
+        value = self._memory_get(key)
+        if value is not None:
+            with self._lock:
+                self._stats["memory_hits"] += 1
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            row = self._disk_get(key)
+            if row:
+                value, expires_at = row
+                self._memory_put(key, value, expires_at)
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+            else:
+                with self._lock:
+                    self._stats["misses"] += 1
+                value = compute()
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current tier sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((lookups - stats["misses"]) / lookups, 4) if lookups else 0.0
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            except sqlite3.Error as e:
+                self._disk_error("count", e)
+        return stats
@@ -0,0 +1,492 @@
+"""
+Versioned schema migrations.
+
+Each migration has an up and (optionally) a down list of steps; a step is a
+SQL string or a function taking the connection. Applied versions are recorded
+in schema_migrations. Transactional migrations run in one transaction
+together with their history row. Non-transactional ones (CREATE INDEX
+CONCURRENTLY, batched backfills) run in autocommit mode and must be safe to
+re-run, since a failure part-way leaves their version unrecorded.
+
+    python migrations.py status
+    python migrations.py up [--target N]
+    python migrations.py down --target N
+
+The application never changes the schema itself; it only checks that the
+database is at LATEST_VERSION (unless DB_AUTO_MIGRATE is set).
+"""
+import os
+import argparse
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple, Union
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from embedding_codec import decode_embedding, encode_embedding
+
+# Rows updated per transaction by backfills
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+
+# pg_advisory_lock key, so two deploys can't migrate at the same time
+MIGRATION_LOCK_ID = 7_310_512_024
+
+Step = Union[str, Callable]
+
+
+class SchemaVersionError(RuntimeError):
+    """Raised when the database schema is older or newer than the code expects."""
+
+
+class Migration:
+    def __init__(self, version: int, name: str, up: List[Step], down: Optional[List[Step]] = None,
+                 transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.up = up
+        self.down = down  # None: can't be reverted
+        self.transactional = transactional
+
+
+def _set_aside_bytea_embeddings(conn) -> None:
+    """
+    Embeddings from the old bytea layout can't be read. Keep them in
+    embeddings_backup and let a fresh embeddings table be created.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'embeddings' AND column_name = 'embedding_vector'
+        ''')
+        row = cursor.fetchone()
+        if row and row[0] == 'bytea':
+            print("Moving bytea embeddings to embeddings_backup; re-analyze documents to regenerate them")
+            cursor.execute('CREATE TABLE IF NOT EXISTS embeddings_backup AS SELECT * FROM embeddings')
+            cursor.execute('DROP TABLE embeddings')
+
+
+def concurrent_index(name: str, table: str, columns: str) -> Callable:
+    """A step building an index without blocking writes to the table."""
+    def create(conn) -> None:
+        with conn.cursor() as cursor:
+            # A failed concurrent build leaves an invalid index that IF NOT EXISTS would keep
+            cursor.execute(
+                '''
+                SELECT NOT i.indisvalid FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s
+                ''',
+                (name,)
+            )
+            row = cursor.fetchone()
+            if row and row[0]:
+                cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})')
+    return create
+
+
+def _backfill_risk_aggregates(conn) -> None:
+    """Fill documents.overall_risk_score/clause_count in batches of MIGRATION_BATCH_SIZE."""
+    total = 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                '''
+                UPDATE documents d SET (overall_risk_score, clause_count) = (
+                    SELECT COALESCE(AVG(r.risk_score), 0), COUNT(*) FROM risk_analysis r WHERE r.document_id = d.id
+                )
+                WHERE d.id IN (
+                    SELECT id FROM documents WHERE clause_count IS NULL ORDER BY id LIMIT %s
+                )
+                ''',
+                (MIGRATION_BATCH_SIZE,)
+            )
+            if cursor.rowcount == 0:
+                break
+            total += cursor.rowcount
+    print(f"Backfilled risk aggregates for {total} documents")
+
+
+def _pack_embeddings(conn) -> None:
+    """
+    Convert FLOAT[] embeddings to packed embedding_blob values (in the
+    EMBEDDING_STORAGE_FORMAT), MIGRATION_BATCH_SIZE rows per transaction.
+    The array is cleared; VACUUM FULL embeddings afterwards to return the space.
+    """
+    total, last_id = 0, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                '''
+                SELECT id, embedding_vector FROM embeddings
+                WHERE embedding_blob IS NULL AND id > %s
+                ORDER BY id LIMIT %s
+                ''',
+                (last_id, MIGRATION_BATCH_SIZE)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            execute_values(
+                cursor,
+                '''
+                UPDATE embeddings e
+                SET embedding_blob = v.blob, embedding_format = v.format, embedding_scale = v.scale,
+                    embedding_vector = NULL
+                FROM (VALUES %s) AS v (id, blob, format, scale)
+                WHERE e.id = v.id
+                ''',
+                [(row_id, *encode_embedding(vector)) for row_id, vector in rows],
+                template='(%s, %s::bytea, %s::smallint, %s::real)',
+                page_size=MIGRATION_BATCH_SIZE
+            )
+            total += len(rows)
+            last_id = rows[-1][0]
+    print(f"Packed {total} embeddings")
+
+
+def _unpack_embeddings(conn) -> None:
+    """Write packed embeddings back to the FLOAT[] column, in batches."""
+    total, last_id = 0, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                '''
+                SELECT id, embedding_blob, embedding_format, embedding_scale FROM embeddings
+                WHERE embedding_vector IS NULL AND id > %s
+                ORDER BY id LIMIT %s
+                ''',
+                (last_id, MIGRATION_BATCH_SIZE)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            execute_values(
+                cursor,
+                '''
+                UPDATE embeddings e SET embedding_vector = v.vector
+                FROM (VALUES %s) AS v (id, vector)
+                WHERE e.id = v.id
+                ''',
+                [(row_id, decode_embedding(blob, code, scale).tolist()) for row_id, blob, code, scale in rows],
+                template='(%s, %s::float[])',
+                page_size=MIGRATION_BATCH_SIZE
+            )
+            total += len(rows)
+            last_id = rows[-1][0]
+    print(f"Unpacked {total} embeddings")
+
+
+# Indexes for the hot queries: clause history by type, chunks and risk rows by
+# document, document lists by owner and date, dedup by hash, job polling
+HOT_QUERY_INDEXES = [
+    ('embeddings_chunk_type_idx', 'embeddings', 'chunk_type'),
+    ('embeddings_document_id_idx', 'embeddings', 'document_id'),
+    ('risk_analysis_document_id_idx', 'risk_analysis', 'document_id'),
+    ('documents_user_upload_idx', 'documents', 'user_id, upload_date DESC, id DESC'),
+    ('documents_content_hash_idx', 'documents', 'content_hash'),
+    ('revoked_tokens_revoked_at_idx', 'revoked_tokens', 'revoked_at'),
+    ('analysis_jobs_pending_idx', 'analysis_jobs', 'status, run_after'),
+]
+
+MIGRATIONS = [
+    # The schema as the application used to create it on startup. Every statement
+    # is idempotent, so databases created that way adopt it unchanged.
+    Migration(1, 'baseline', [
+        '''
+        CREATE TABLE IF NOT EXISTS documents (
+            id SERIAL PRIMARY KEY,
+            filename TEXT NOT NULL,
+            doc_type TEXT NOT NULL,
+            upload_date TIMESTAMP NOT NULL,
+            full_text TEXT NOT NULL,
+            metadata JSONB
+        )
+        ''',
+        'ALTER TABLE documents ADD COLUMN IF NOT EXISTS user_id INTEGER',
+        'ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT',
+        'ALTER TABLE documents ADD COLUMN IF NOT EXISTS storage_path TEXT',
+        'ALTER TABLE documents ADD COLUMN IF NOT EXISTS overall_risk_score FLOAT',
+        'ALTER TABLE documents ADD COLUMN IF NOT EXISTS clause_count INTEGER',
+        _set_aside_bytea_embeddings,
+        '''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            id SERIAL PRIMARY KEY,
+            document_id INTEGER REFERENCES documents(id),
+            chunk_text TEXT NOT NULL,
+            embedding_vector FLOAT[] NOT NULL,
+            chunk_type TEXT,
+            risk_score FLOAT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS risk_analysis (
+            id SERIAL PRIMARY KEY,
+            document_id INTEGER REFERENCES documents(id),
+            clause_type TEXT NOT NULL,
+            clause_text TEXT NOT NULL,
+            risk_score FLOAT NOT NULL,
+            risk_explanation TEXT,
+            analysis_date TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS analysis_snapshots (
+            id SERIAL PRIMARY KEY,
+            document_id INTEGER NOT NULL REFERENCES documents(id),
+            version INTEGER NOT NULL,
+            format_version INTEGER NOT NULL,
+            analysis JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            UNIQUE (document_id, version)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS document_queries (
+            id SERIAL PRIMARY KEY,
+            document_id INTEGER REFERENCES documents(id),
+            user_id INTEGER,
+            query TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            streamed BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            user_id INTEGER,
+            expires_at TIMESTAMP NOT NULL,
+            revoked_at TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS analysis_jobs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            file_path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            document_id INTEGER REFERENCES documents(id),
+            result JSONB,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            run_after TIMESTAMP NOT NULL,
+            locked_until TIMESTAMP
+        )
+        ''',
+    ]),
+    Migration(
+        2, 'hot_query_indexes',
+        [concurrent_index(name, table, columns) for name, table, columns in HOT_QUERY_INDEXES],
+        [f'DROP INDEX CONCURRENTLY IF EXISTS {name}' for name, _, _ in HOT_QUERY_INDEXES],
+        transactional=False
+    ),
+    Migration(
+        3, 'backfill_risk_aggregates',
+        [_backfill_risk_aggregates],
+        # The aggregates are kept up to date by the application; nothing to undo
+        [],
+        transactional=False
+    ),
+    Migration(
+        4, 'compact_embeddings',
+        [
+            'ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS embedding_blob BYTEA',
+            'ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS embedding_format SMALLINT',
+            'ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS embedding_scale REAL',
+            'ALTER TABLE embeddings ALTER COLUMN embedding_vector DROP NOT NULL',
+            _pack_embeddings,
+        ],
+        [
+            _unpack_embeddings,
+            'ALTER TABLE embeddings ALTER COLUMN embedding_vector SET NOT NULL',
+            'ALTER TABLE embeddings DROP COLUMN IF EXISTS embedding_blob',
+            'ALTER TABLE embeddings DROP COLUMN IF EXISTS embedding_format',
+            'ALTER TABLE embeddings DROP COLUMN IF EXISTS embedding_scale',
+        ],
+        transactional=False
+    ),
+    # At most one queued or running job per user and upload, so concurrent
+    # uploads of the same file share one analysis
+    Migration(5, 'analysis_job_content_hash', [
+        'ALTER TABLE analysis_jobs ADD COLUMN IF NOT EXISTS content_hash TEXT',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS analysis_jobs_active_hash_idx
+        ON analysis_jobs (user_id, content_hash)
+        WHERE status IN ('queued', 'running')
+        ''',
+    ], [
+        'DROP INDEX IF EXISTS analysis_jobs_active_hash_idx',
+        'ALTER TABLE analysis_jobs DROP COLUMN IF EXISTS content_hash',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _run_step(conn, step: Step) -> None:
+    if callable(step):
+        step(conn)
+    else:
+        with conn.cursor() as cursor:
+            cursor.execute(step)
+
+
+def _ensure_history_table(conn) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL
+            )
+        ''')
+
+
+def applied_migrations(conn) -> List[Tuple[int, str, datetime]]:
+    """(version, name, applied_at) of every applied migration, oldest first."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return []
+        cursor.execute('SELECT version, name, applied_at FROM schema_migrations ORDER BY version')
+        return cursor.fetchall()
+
+
+def current_version(conn) -> int:
+    """The highest applied migration version; 0 for a database never migrated."""
+    applied = applied_migrations(conn)
+    return applied[-1][0] if applied else 0
+
+
+def _apply(conn, migration: Migration, steps: List[Step], record: Callable) -> None:
+    """Run one migration's steps and update the history, in a transaction if it allows one."""
+    conn.autocommit = not migration.transactional
+    try:
+        for step in steps:
+            _run_step(conn, step)
+        with conn.cursor() as cursor:
+            record(cursor)
+        if migration.transactional:
+            conn.commit()
+    except Exception:
+        if migration.transactional:
+            conn.rollback()
+        raise
+
+
+def _run_locked(conn, run: Callable) -> List[int]:
+    """Run under the migration lock, restoring the connection's autocommit mode."""
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+    try:
+        _ensure_history_table(conn)
+        return run()
+    finally:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        conn.autocommit = autocommit
+
+
+def migrate(conn, target: Optional[int] = None) -> List[int]:
+    """
+    Apply pending migrations up to target (default: all). Returns the versions
+    applied. conn must not be inside a transaction.
+    """
+    target = LATEST_VERSION if target is None else target
+
+    def run() -> List[int]:
+        applied = []
+        version = current_version(conn)
+        for migration in MIGRATIONS:
+            if version < migration.version <= target:
+                print(f"Applying migration {migration.version} ({migration.name})...")
+                _apply(conn, migration, migration.up, lambda cursor: cursor.execute(
+                    'INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)',
+                    (migration.version, migration.name, datetime.now())
+                ))
+                applied.append(migration.version)
+        return applied
+
+    return _run_locked(conn, run)
+
+
+def rollback(conn, target: int) -> List[int]:
+    """Revert applied migrations newer than target, newest first. Returns the versions reverted."""
+    def run() -> List[int]:
+        reverted = []
+        version = current_version(conn)
+        for migration in reversed(MIGRATIONS):
+            if target < migration.version <= version:
+                if migration.down is None:
+                    raise SchemaVersionError(f"Migration {migration.version} ({migration.name}) can't be reverted")
+                print(f"Reverting migration {migration.version} ({migration.name})...")
+                _apply(conn, migration, migration.down, lambda cursor: cursor.execute(
+                    'DELETE FROM schema_migrations WHERE version = %s', (migration.version,)
+                ))
+                reverted.append(migration.version)
+        return reverted
+
+    return _run_locked(conn, run)
+
+
+def check_version(conn) -> int:
+    """Raise SchemaVersionError unless the database is at LATEST_VERSION."""
+    version = current_version(conn)
+    if version < LATEST_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {version}, expected {LATEST_VERSION}; run `python migrations.py up`"
+        )
+    if version > LATEST_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {version}, newer than this code ({LATEST_VERSION})"
+        )
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply or revert database schema migrations')
+    parser.add_argument('command', choices=['status', 'up', 'down'])
+    parser.add_argument('--target', type=int, help='Version to migrate to (default for up: latest)')
+    args = parser.parse_args()
+    if args.command == 'down' and args.target is None:
+        parser.error('down needs --target')
+
+    from contract_analyzer import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+
+    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+    try:
+        if args.command == 'up':
+            applied = migrate(conn, args.target)
+            print(f"Applied {applied}" if applied else "Nothing to apply")
+        elif args.command == 'down':
+            reverted = rollback(conn, args.target)
+            print(f"Reverted {reverted}" if reverted else "Nothing to revert")
+
+        applied = {version: applied_at for version, _, applied_at in applied_migrations(conn)}
+        for migration in MIGRATIONS:
+            applied_at = applied.get(migration.version)
+            state = f"applied {applied_at:%Y-%m-%d %H:%M:%S}" if applied_at else "pending"
+            print(f"{migration.version:4d}  {migration.name:28s} {state}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import { PieChart, Pie, Cell, BarChart, Bar, XAxis, YAxis, CartesianGrid, Toolti
 import { 
   getDocumentAnalysis,
   queryDocument,
+  streamQueryDocument,
   downloadDocument,
   downloadAnalysisReport,
   saveAnalysisToLocal
@@ -64,8 +65,26 @@ const DocumentAnalysis = () => {
       setQueryLoading(true);
       setQueryResult(null);
       
-      const result = await queryDocument(documentId, query);
-      setQueryResult(result);
+      // Show the answer as it streams in; fall back to the blocking endpoint if streaming
+      // fails before the first token
+      let answer = '';
+      let result;
+      try {
+        result = await streamQueryDocument(documentId, query, (token) => {
+          answer += token;
+          setQueryLoading(false);
+          setQueryResult({ answer });
+        });
+      } catch (streamError) {
+        console.error(streamError);
+        if (answer) {
+          // Keep the partial answer on screen instead of asking the question again
+          setQueryResult({ answer, error: 'The answer was cut off. Please try again.' });
+          return;
+        }
+        result = await queryDocument(documentId, query);
+      }
+      setQueryResult(result || { answer });
     } catch (err) {
       console.error(err);
       setQueryResult({ error: 'Failed to process query. Please try again.' });
@@ -388,7 +407,7 @@ const DocumentAnalysis = () => {
                         </div>
                       )}
                       
-                      {queryResult && !queryResult.error && (
+                      {queryResult && (!queryResult.error || queryResult.answer) && (
                         <Card>
                           <Card.Header>Answer</Card.Header>
                           <Card.Body>
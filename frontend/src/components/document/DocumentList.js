@@ -1,20 +1,25 @@
 import React, { useState, useEffect } from 'react';
 import { Container, Card, Table, Button, Alert, Badge, Spinner } from 'react-bootstrap';
 import { Link } from 'react-router-dom';
-import { getUserDocuments } from '../../services/documentService';
+import { getUserDocumentsPage } from '../../services/documentService';
+
+const PAGE_SIZE = 50;
 
 const DocumentList = () => {
   const [documents, setDocuments] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
   const [error, setError] = useState('');
 
-  // Load user's documents on component mount
+  // Load the first page of user's documents on component mount
   useEffect(() => {
     const fetchDocuments = async () => {
       try {
         setLoading(true);
-        const data = await getUserDocuments();
-        setDocuments(data);
+        const page = await getUserDocumentsPage({ limit: PAGE_SIZE });
+        setDocuments(page.documents);
+        setNextCursor(page.nextCursor);
       } catch (err) {
         setError('Failed to load documents. Please try again later.');
         console.error(err);
@@ -26,6 +31,21 @@ const DocumentList = () => {
     fetchDocuments();
   }, []);
 
+  // Append the next page
+  const loadMore = async () => {
+    try {
+      setLoadingMore(true);
+      const page = await getUserDocumentsPage({ limit: PAGE_SIZE, cursor: nextCursor });
+      setDocuments((current) => [...current, ...page.documents]);
+      setNextCursor(page.nextCursor);
+    } catch (err) {
+      setError('Failed to load more documents. Please try again later.');
+      console.error(err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   // Get badge color based on risk score
   const getRiskBadgeVariant = (riskScore) => {
     if (riskScore >= 0.7) return 'danger';
@@ -99,6 +119,14 @@ const DocumentList = () => {
               </tbody>
             </Table>
           )}
+
+          {nextCursor && (
+            <div className="text-center">
+              <Button variant="outline-secondary" onClick={loadMore} disabled={loadingMore}>
+                {loadingMore ? 'Loading...' : 'Load More'}
+              </Button>
+            </div>
+          )}
         </Card.Body>
       </Card>
     </Container>
@@ -30,6 +30,13 @@ export const login = async (credentials) => {
 
 // Logout user
 export const logout = () => {
+  // Revoke the token server-side too; the local logout doesn't wait for it
+  const token = getCurrentUserToken();
+  if (token) {
+    axios.post(`${API_URL}/auth/logout`, null, {
+      headers: { Authorization: `Bearer ${token}` }
+    }).catch(() => {});
+  }
   sessionStorage.removeItem('user_token');
 };
 
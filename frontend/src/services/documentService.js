@@ -1,4 +1,4 @@
-import { authAxios } from './authService';
+import { authAxios, getCurrentUserToken } from './authService';
 import FileSaver from 'file-saver';
 import { jsPDF } from "jspdf";
 import autoTable from "jspdf-autotable"
@@ -139,21 +139,52 @@ export const generatePDFFromJSON = (jsonData) => {
   // Save the PDF
   doc.save(`analysis_report_${jsonData.filename.split('.')[0]}.pdf`);
 };
+const JOB_POLL_INTERVAL_MS = 2000;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// Poll a background analysis job until it finishes and return its result
+const waitForAnalysisJob = async (jobId) => {
+  while (true) {
+    let job;
+    try {
+      const response = await authAxios.get(`/jobs/${jobId}`);
+      job = response.data;
+    } catch (error) {
+      throw error.response ? error.response.data : new Error('Server error');
+    }
+
+    if (job.status === 'succeeded') {
+      return job.result;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'Document analysis failed');
+    }
+    await sleep(JOB_POLL_INTERVAL_MS);
+  }
+};
+
 // Upload a document for analysis
 export const uploadDocument = async (file) => {
   const formData = new FormData();
   formData.append('file', file);
 
+  let response;
   try {
-    const response = await authAxios.post(`${API_URL}/upload`, formData, {
+    response = await authAxios.post(`${API_URL}/upload`, formData, {
       headers: {
         'Content-Type': 'multipart/form-data',
       },
     });
-    return response.data;
   } catch (error) {
     throw error.response ? error.response.data : new Error('Server error');
   }
+
+  // Analysis runs in the background; wait for the queued job
+  if (response.status === 202) {
+    return waitForAnalysisJob(response.data.job_id);
+  }
+  return response.data;
 };
 
 // Get document analysis results
@@ -176,6 +207,17 @@ export const getUserDocuments = async () => {
   }
 };
 
+// Get one page of the user's documents, newest first; params may include
+// limit, cursor (from the previous page), doc_type and risk
+export const getUserDocumentsPage = async (params = {}) => {
+  try {
+    const response = await authAxios.get(`${API_URL}/user`, { params });
+    return { documents: response.data, nextCursor: response.headers['x-next-cursor'] || null };
+  } catch (error) {
+    throw error.response ? error.response.data : new Error('Server error');
+  }
+};
+
 // Query a document
 export const queryDocument = async (documentId, query) => {
   try {
@@ -186,6 +228,54 @@ export const queryDocument = async (documentId, query) => {
   }
 };
 
+// Query a document and receive the answer as it is generated (server-sent events).
+// onToken is called with each piece of the answer; resolves with the final result.
+export const streamQueryDocument = async (documentId, query, onToken) => {
+  const response = await fetch(`${authAxios.defaults.baseURL}${API_URL}/${documentId}/query/stream`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${getCurrentUserToken()}`,
+    },
+    body: JSON.stringify({ query }),
+  });
+
+  if (!response.ok) {
+    throw await response.json().catch(() => new Error('Server error'));
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result = null;
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      const event = (block.match(/^event: (.*)$/m) || [])[1];
+      const data = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || '{}');
+
+      if (event === 'token') {
+        onToken(data.text);
+      } else if (event === 'done') {
+        result = data;
+      } else if (event === 'error') {
+        throw new Error(data.message);
+      }
+    }
+  }
+
+  return result;
+};
+
 // Download the original document
 export const downloadDocument = async (documentId, filename) => {
   try {